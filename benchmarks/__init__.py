@@ -0,0 +1 @@
+"""Benchmarks for pasqui. Run each module with `python -m benchmarks.<name>` from the repository root."""
@@ -0,0 +1,96 @@
+"""Generate synthetic PDF, DOCX and TXT corpora for the benchmarks.
+
+Every document gets its own seeded text, so documents differ from each other but a corpus is
+identical from run to run:
+
+    python -m benchmarks.corpus out_dir [--docs 100] [--pages 10] [--formats pdf docx txt]
+"""
+import os
+import random
+import argparse
+import textwrap
+
+words = ("survey household income policy region market health school farmer credit women water "
+         "programme reform growth labour migration price village district access service data "
+         "effect evidence impact study sample treatment outcome analysis model result").split()
+
+def synthetic_sentences(rng, count):
+    """Return `count` random sentences of 8 to 20 words."""
+    sentences = []
+    for _ in range(count):
+        sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(8, 20)))
+        sentences.append(sentence.capitalize() + '.')
+    return sentences
+
+def synthetic_pages(seed, pages, sentences_per_page=40):
+    """Return the text of every page of a document."""
+    rng = random.Random(seed)
+    return [' '.join(synthetic_sentences(rng, sentences_per_page)) for _ in range(pages)]
+
+def pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path, pages):
+    """Write a minimal text PDF with one page per string, wrapped at 90 characters."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>']
+    kids = ' '.join(f'{3 + 2 * i} 0 R' for i in range(len(pages)))
+    objects.append(f'<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>')
+    font = 3 + 2 * len(pages)
+    for i, page in enumerate(pages):
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 {font} 0 R >> >> /Contents {4 + 2 * i} 0 R >>')
+        lines = ' T* '.join(f'({pdf_escape(line)}) Tj' for line in textwrap.wrap(page, 90))
+        stream = f'BT /F1 9 Tf 11 TL 40 760 Td {lines} ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    objects.append('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    out = '%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f'{i + 1} 0 obj\n{obj}\nendobj\n'
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(out)
+
+def write_docx(path, pages):
+    """Write a DOCX document with one paragraph per page."""
+    import docx
+    document = docx.Document()
+    for page in pages:
+        document.add_paragraph(page)
+    document.save(path)
+
+def write_txt(path, pages):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(pages))
+
+writers = {'pdf': write_pdf, 'docx': write_docx, 'txt': write_txt}
+
+def make_corpus(directory, docs, pages=10, formats=('pdf', 'docx', 'txt'), seed=0):
+    """Write `docs` documents, cycling through `formats`, and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(docs):
+        extension = formats[i % len(formats)]
+        path = os.path.join(directory, f'doc{i:05d}.{extension}')
+        writers[extension](path, synthetic_pages(seed * 1000003 + i, pages))
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--docs', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--formats', nargs='+', choices=sorted(writers), default=['pdf', 'docx', 'txt'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    paths = make_corpus(args.directory, args.docs, args.pages, args.formats, args.seed)
+    print(f"Wrote {len(paths)} documents to {args.directory}")
+
+if __name__ == '__main__':
+    main()
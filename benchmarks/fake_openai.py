@@ -0,0 +1,153 @@
+"""A local stand-in for the OpenAI embeddings and chat completions endpoints.
+
+Responses are deterministic (embeddings are seeded by the input text) and every request waits
+`latency` seconds. With `requests_per_minute` the server answers 429 with a Retry-After header
+once its budget is spent, like the real API. Point pasqui at it with the `api_base` variable:
+
+    python -m benchmarks.fake_openai [--port 8000] [--latency 0.2] [--rpm 3000]
+    api_base=http://127.0.0.1:8000/v1 api_key=anything python my_script.py
+"""
+import re
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+# kor's CSV encoder expects a |-delimited table; anything else counts as a summary question
+extraction_marker = 'CSV format'
+# Packed summary requests (pasqui_asks(packed=True)) number their questions and expect JSON back
+packed_marker = 'mapping every question number'
+
+class FakeOpenAI:
+    """Fake OpenAI server running on a background thread, counting the requests it receives."""
+
+    def __init__(self, latency=0.05, jitter=0.0, requests_per_minute=None, dim=256,
+                 extraction_reply='topic|year\nbenchmark|2024', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.dim = dim
+        self.extraction_reply = extraction_reply
+        self.counts = {'embeddings': 0, 'chat': 0, 'inputs': 0, 'rate_limited': 0}
+        self._lock = threading.Lock()
+        self._allowance = float(requests_per_minute or 0)
+        self._updated = time.monotonic()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self):
+        """Return a copy of the request counters."""
+        with self._lock:
+            return dict(self.counts)
+
+    def _admit(self):
+        """Spend one request of the per-minute budget, returning the wait in seconds if it is spent."""
+        if not self.requests_per_minute:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.requests_per_minute,
+                                  self._allowance + (now - self._updated) * self.requests_per_minute / 60)
+            self._updated = now
+            if self._allowance >= 1:
+                self._allowance -= 1
+                return 0
+            self.counts['rate_limited'] += 1
+            return (1 - self._allowance) * 60 / self.requests_per_minute
+
+    def embed(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode('utf-8'))).normal(size=self.dim).tolist()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, headers=()):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                wait = fake._admit()
+                if wait:
+                    self.reply(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                               [('retry-after', f"{wait:.3f}")])
+                    return
+                time.sleep(fake.latency + random.random() * fake.jitter)
+
+                if self.path.endswith('/embeddings'):
+                    inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+                    with fake._lock:
+                        fake.counts['embeddings'] += 1
+                        fake.counts['inputs'] += len(inputs)
+                    data = [{'object': 'embedding', 'index': i, 'embedding': fake.embed(text)}
+                            for i, text in enumerate(inputs)]
+                    self.reply(200, {'object': 'list', 'data': data, 'model': body['model'],
+                                     'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+                elif self.path.endswith('/chat/completions'):
+                    with fake._lock:
+                        fake.counts['chat'] += 1
+                    prompt = '\n'.join(str(m.get('content', '')) for m in body['messages'])
+                    if extraction_marker in prompt:
+                        content = fake.extraction_reply
+                    elif packed_marker in prompt:
+                        numbers = re.findall(r'^(\d+)\. ', prompt.split(packed_marker, 1)[1], re.M)
+                        content = json.dumps({n: f"Answer {n} based on {len(prompt)} characters of context."
+                                              for n in numbers})
+                    else:
+                        content = f"Answer based on {len(prompt)} characters of context."
+                    self.reply(200, {'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                                     'choices': [{'index': 0, 'finish_reason': 'stop',
+                                                  'message': {'role': 'assistant', 'content': content}}],
+                                     'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}})
+                else:
+                    self.reply(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds, up to this much')
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute before answering 429')
+    parser.add_argument('--dim', type=int, default=256, help='embedding dimensions')
+    args = parser.parse_args()
+
+    server = FakeOpenAI(args.latency, args.jitter, args.rpm, args.dim, port=args.port).start()
+    print(f"Serving a fake OpenAI API at {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Measure the startup cost of `import pasqui` and of each public entry point.
+
+Every measurement runs in a fresh interpreter without an API key set, so it also checks that
+importing the package no longer requires one.
+
+    python -m benchmarks.import_time [--repeat 5] [--json results.json]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+entry_points = [
+    None,  # Bare `import pasqui`
+    'pasqui_converting',
+    'pasqui_deduplicating',
+    'pasqui_embedding',
+    'pasqui_asks',
+    'pasqui_summarising',
+    'pasqui_indexing',
+    'pasqui_corpus_asks',
+    'pasqui_structuring',
+    'pasqui_pipeline',
+    'convert_embeddings_csv',
+]
+
+snippet = """
+import time
+start = time.perf_counter()
+import pasqui
+{access}
+print(time.perf_counter() - start)
+"""
+
+def measure(entry_point, repeat=5):
+    """Return the import times, in seconds, of an entry point over `repeat` fresh interpreters."""
+    access = f"pasqui.{entry_point}" if entry_point else ""
+    env = {k: v for k, v in os.environ.items() if k != 'api_key'}
+    env['PYTHONPATH'] = src + os.pathsep + env.get('PYTHONPATH', '')
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', snippet.format(access=access)],
+                                env=env, capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    for entry_point in entry_points:
+        name = entry_point or 'import pasqui'
+        times = measure(entry_point, args.repeat)
+        results[name] = {'median_s': statistics.median(times), 'min_s': min(times), 'max_s': max(times)}
+        print(f"{name:<24} median {results[name]['median_s'] * 1000:8.1f} ms   min {min(times) * 1000:8.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
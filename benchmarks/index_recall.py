@@ -0,0 +1,86 @@
+"""Measure query latency and recall of the corpus index against exact search.
+
+Builds an index of synthetic clustered unit vectors (documents of `--chunks-per-doc` chunks),
+trains it, then compares the top-k of CorpusIndex.search with brute-force search for several
+nprobe values.
+
+    python -m benchmarks.index_recall [--chunks 200000] [--dim 256] [--queries 200] [--k 20]
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from pasqui.index import CorpusIndex, normalize, top_k
+
+def synthetic_corpus(chunks, dim, topics, seed=0):
+    """Return unit vectors drawn around `topics` random directions, like chunks of related documents."""
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.normal(size=(topics, dim)))
+    labels = rng.integers(topics, size=chunks)
+    return normalize(centers[labels] + 0.6 * normalize(rng.normal(size=(chunks, dim)))), centers
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--chunks-per-doc', type=int, default=200)
+    parser.add_argument('--topics', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--index-dir', help='where to build the index (default: a temporary directory)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    vectors, centers = synthetic_corpus(args.chunks, args.dim, args.topics)
+    rng = np.random.default_rng(1)
+    queries = normalize(centers[rng.integers(args.topics, size=args.queries)]
+                        + 0.6 * normalize(rng.normal(size=(args.queries, args.dim))))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = CorpusIndex(args.index_dir or tmp)
+        start = time.perf_counter()
+        for doc, first in enumerate(range(0, args.chunks, args.chunks_per_doc)):
+            block = vectors[first:first + args.chunks_per_doc]
+            index.add_document(f"doc{doc}", [f"{doc}:{i}" for i in range(len(block))], block)
+        add_s = time.perf_counter() - start
+        start = time.perf_counter()
+        index.train(args.nlist)
+        train_s = time.perf_counter() - start
+        print(f"{args.chunks} chunks, dim {args.dim}: added in {add_s:.1f}s, trained {index.nlist} lists in {train_s:.1f}s")
+
+        # Exact top-k by brute force
+        exact = []
+        for query in queries:
+            best = top_k(vectors @ query, args.k)
+            exact.append({f"{i // args.chunks_per_doc}:{i % args.chunks_per_doc}" for i in best})
+
+        results = {'chunks': args.chunks, 'dim': args.dim, 'nlist': index.nlist, 'k': args.k,
+                   'add_s': add_s, 'train_s': train_s, 'nprobe': {}}
+        for nprobe in args.nprobe:
+            latencies = []
+            recall = []
+            for query, truth in zip(queries, exact):
+                start = time.perf_counter()
+                hits = index.search(query, k=args.k, nprobe=nprobe)[0]
+                latencies.append(time.perf_counter() - start)
+                recall.append(len({text for _, text, _ in hits} & truth) / len(truth))
+            row = {'recall': float(np.mean(recall)), 'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                   'p99_ms': float(np.percentile(latencies, 99) * 1000)}
+            results['nprobe'][nprobe] = row
+            print(f"nprobe {nprobe:>4}: recall@{args.k} {row['recall']:.3f}   "
+                  f"p50 {row['p50_ms']:.2f} ms   p99 {row['p99_ms']:.2f} ms")
+        index.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
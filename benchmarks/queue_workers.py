@@ -0,0 +1,220 @@
+"""Check the work queue by running every pasqui stage with several worker processes at once.
+
+Each stage (convert, embed, summarise, structure) is run by --workers processes sharing one queue
+file, against a local fake OpenAI server. Every worker records the tasks whose commit it made;
+the check then asserts that every task of the stage is done and was committed exactly once, and
+that the workbook has one row per document.
+
+    python -m benchmarks.queue_workers [--docs 24] [--workers 3] [--crash] [--json out.json]
+
+With --crash the first worker of every stage exits while holding a lease, so the check also
+covers lease expiry and the task being handed to another worker (after --lease-seconds).
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import uuid
+import tempfile
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'src'))
+from benchmarks.corpus import make_corpus
+from benchmarks.fake_openai import FakeOpenAI
+
+stages = ['convert', 'embed', 'summarise', 'structure']
+
+questions = ["What is the main topic of the study?", "Which region does the study cover?"]
+
+def paths(work_dir):
+    return {name: os.path.join(work_dir, name) for name in ('input', 'texts', 'embeddings', 'summaries', 'logs',
+                                                             'commits')}
+
+def record_commits(log_path, crash, stage):
+    """Make every LeaseQueue of this process append the names it commits for stage to log_path.
+
+    With crash the process exits at its second commit, before making it, so the lease it holds
+    has to expire before another worker gets the task.
+    """
+    from pasqui import workqueue
+    complete = workqueue.LeaseQueue.complete
+
+    def recording_complete(self, lease, artefact=None):
+        if not lease.stage.startswith(stage + ':'):
+            return complete(self, lease, artefact)  # e.g. the workbook export after the structure stage
+        if crash and os.path.exists(log_path):
+            os._exit(3)
+        committed = complete(self, lease, artefact)
+        if committed:
+            with open(log_path, 'a') as log:
+                log.write(lease.name + '\n')
+        return committed
+
+    workqueue.LeaseQueue.complete = recording_complete
+
+def run_worker(stage, work_dir, index, lease_seconds, crash, run_id):
+    """Run one stage as worker number index of run run_id."""
+    dirs = paths(work_dir)
+    queue = os.path.join(work_dir, 'queue.sqlite')
+    record_commits(os.path.join(dirs['commits'], f'{stage}-{index}.txt'), crash, stage)
+
+    if stage == 'convert':
+        from pasqui import module1
+        module1.pasqui_converting(dirs['input'], dirs['texts'], os.path.join(dirs['logs'], f'convert-{index}.log'),
+                                  work_queue=queue, lease_seconds=lease_seconds, run_id=run_id)
+    elif stage == 'embed':
+        from pasqui import module2
+        module2.pasqui_embedding(dirs['texts'], dirs['embeddings'], claim_size=2, work_queue=queue,
+                                 lease_seconds=lease_seconds, run_id=run_id)
+    elif stage == 'summarise':
+        from pasqui import module3
+        module3.pasqui_summarising(dirs['embeddings'], dirs['summaries'], questions,
+                                   [f"Q{i}" for i in range(len(questions))], module3.pasqui_asks,
+                                   os.path.join(dirs['logs'], f'summarise-{index}.log'), work_queue=queue,
+                                   lease_seconds=lease_seconds, run_id=run_id)
+    elif stage == 'structure':
+        from kor.nodes import Object, Text, Number
+        from pasqui import module4
+        instruction = Object(id="study", description="Details of the study", attributes=[
+            Text(id="topic", description="The main topic of the study"),
+            Number(id="year", description="The year the study was published"),
+        ])
+        module4.pasqui_structuring(dirs['summaries'], os.path.join(work_dir, 'results.xlsx'),
+                                   os.path.join(dirs['logs'], 'structure_errors.log'),
+                                   os.path.join(dirs['logs'], 'structured.log'), ['File', 'topic', 'year'],
+                                   instruction=instruction, work_queue=queue, lease_seconds=lease_seconds,
+                                   run_id=run_id)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+def expected_tasks(stage, work_dir):
+    """Return the names of the tasks a stage should commit."""
+    dirs = paths(work_dir)
+    if stage == 'convert':
+        return {f for f in os.listdir(dirs['input']) if f.endswith(('.pdf', '.docx'))}
+    if stage == 'embed':
+        return {f for f in os.listdir(dirs['texts']) if f.endswith('.txt')}
+    if stage == 'summarise':
+        return {f for f in os.listdir(dirs['embeddings']) if f.endswith('.csv')}
+    return {f for f in os.listdir(dirs['summaries']) if f.endswith('.txt')}
+
+def check_stage(stage, work_dir, workers):
+    """Return the per-worker commit counts and queue state of a stage, and the problems found."""
+    from pasqui.workqueue import LeaseQueue
+    commits = {}
+    for index in range(workers):
+        log_path = os.path.join(paths(work_dir)['commits'], f'{stage}-{index}.txt')
+        if os.path.exists(log_path):
+            with open(log_path) as log:
+                commits[index] = log.read().split()
+
+    committed = [name for names in commits.values() for name in names]
+    expected = expected_tasks(stage, work_dir)
+    problems = []
+    duplicated = sorted({name for name in committed if committed.count(name) > 1})
+    if duplicated:
+        problems.append(f"committed more than once: {duplicated}")
+    if set(committed) != expected:
+        problems.append(f"never committed: {sorted(expected - set(committed))}, "
+                        f"unexpected: {sorted(set(committed) - expected)}")
+
+    # Every stage of this run has a single queue stage (see workqueue.stage_key)
+    queue = LeaseQueue(os.path.join(work_dir, 'queue.sqlite'))
+    try:
+        (queue_stage,) = [name for name in queue.stages() if name.startswith(stage + ':')]
+        state = queue.stats(queue_stage)
+    finally:
+        queue.close()
+    if state['done'] != len(expected) or state['pending'] or state['leased'] or state['failed']:
+        problems.append(f"queue not drained: {state}")
+    return {'commits': {index: len(names) for index, names in commits.items()}, 'queue': state}, problems
+
+def check_workbook(work_dir, docs):
+    """Return the problems with the workbook exported by the structure stage."""
+    import openpyxl
+    workbook = openpyxl.load_workbook(os.path.join(work_dir, 'results.xlsx'), read_only=True)
+    files = [row[0] for row in workbook['Results'].iter_rows(min_row=2, values_only=True)]
+    workbook.close()
+    if sorted(files) != sorted(set(files)) or len(files) != docs:
+        return [f"workbook has {len(files)} rows ({len(set(files))} files) for {docs} documents"]
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=24)
+    parser.add_argument('--pages', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=3, help='worker processes per stage')
+    parser.add_argument('--crash', action='store_true', help='make the first worker of every stage die holding a lease')
+    parser.add_argument('--lease-seconds', type=float, default=None,
+                        help='lease duration (default: 3 with --crash, else 300)')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake server adds to each request')
+    parser.add_argument('--work-dir', help='where to write the corpus and outputs (default: a temporary directory)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--run-worker', nargs=2, metavar=('STAGE', 'INDEX'), help=argparse.SUPPRESS)
+    parser.add_argument('--run-id', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    lease_seconds = args.lease_seconds or (3 if args.crash else 300)
+
+    # Child process: run a single stage as one of the workers
+    if args.run_worker:
+        stage, index = args.run_worker
+        run_worker(stage, args.work_dir, int(index), lease_seconds, args.crash and index == '0', args.run_id)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pasqui-queue-')
+    dirs = paths(work_dir)
+    for directory in dirs.values():
+        os.makedirs(directory, exist_ok=True)
+    make_corpus(dirs['input'], args.docs, args.pages, formats=('pdf', 'docx'))
+
+    server = FakeOpenAI(args.latency).start()
+    env = dict(os.environ, api_base=server.url, api_key='benchmark')
+    env['PYTHONPATH'] = root + os.pathsep + os.path.join(root, 'src') + os.pathsep + env.get('PYTHONPATH', '')
+
+    results = {'config': {k: v for k, v in vars(args).items() if k not in ('run_worker', 'run_id')}, 'stages': {}}
+    failed = False
+    run_id = uuid.uuid4().hex  # Shared by the workers, so only the first one to start resets tasks
+    try:
+        for stage in stages:
+            before = server.snapshot()
+            command = [sys.executable, '-m', 'benchmarks.queue_workers', '--work-dir', work_dir,
+                       '--lease-seconds', str(lease_seconds), '--run-id', run_id] + \
+                      (['--crash'] if args.crash else [])
+            logs = [open(os.path.join(dirs['logs'], f'{stage}-worker-{index}.out'), 'w') for index in range(args.workers)]
+            processes = [subprocess.Popen(command + ['--run-worker', stage, str(index)], env=env, cwd=root,
+                                          stdout=log, stderr=subprocess.STDOUT)
+                         for index, log in enumerate(logs)]
+            exit_codes = [process.wait() for process in processes]
+            for log in logs:
+                log.close()
+            after = server.snapshot()
+
+            row, problems = check_stage(stage, work_dir, args.workers)
+            expected_codes = [3 if args.crash and index == 0 else 0 for index in range(args.workers)]
+            if exit_codes != expected_codes:
+                problems.append(f"worker exit codes {exit_codes}, expected {expected_codes} "
+                                f"(see {dirs['logs']}/{stage}-worker-*.out)")
+            if stage == 'structure':
+                problems += check_workbook(work_dir, args.docs)
+            row.update(api_calls={k: after[k] - before[k] for k in ('embeddings', 'chat')}, problems=problems)
+            results['stages'][stage] = row
+            failed = failed or bool(problems)
+            print(f"{stage:<10} {'FAIL' if problems else 'ok':<5} commits per worker {row['commits']}  "
+                  f"queue {row['queue']}  API calls {row['api_calls']}")
+            for problem in problems:
+                print(f"    {problem}")
+    finally:
+        server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        raise SystemExit("Queue check failed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Benchmark every pasqui stage on a synthetic corpus against a local fake OpenAI server.
+
+Stages run in order, each in a fresh interpreter so the peak RSS reported is its own:
+
+    convert     pasqui_converting on the PDF and DOCX documents
+    chunk       split_strings_from_subsection on every text
+    embed       pasqui_embedding on every text (TXT documents skip conversion)
+    load        load_embeddings of every table
+    retrieve    strings_ranked_by_relatedness of every question against every table
+    summarise   pasqui_summarising
+    structure   pasqui_structuring
+
+For each stage it reports documents per second, p50/p99 latency of the unit of work named in
+the `latency_of` column, peak RSS and API calls per document (429 answers counted apart). The
+API stages are timed after a warm-up request, so importing openai and building the client are not
+measured; the warm-up is not counted either. Save runs with --json and compare them across commits.
+
+    python -m benchmarks.stages [--docs 60] [--pages 10] [--latency 0.05] [--rpm 3000] [--json out.json]
+
+With --packed the summarise stage asks questions with overlapping context in shared requests.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'src'))
+from benchmarks.corpus import make_corpus
+from benchmarks.fake_openai import FakeOpenAI
+
+stages = ['convert', 'chunk', 'embed', 'load', 'retrieve', 'summarise', 'structure']
+
+questions = ["What is the main topic of the study?", "Which region does the study cover?",
+             "What data does the study use?", "What are the main results?", "What policy is evaluated?"]
+
+@contextlib.contextmanager
+def timed(module, name, latencies):
+    """Temporarily wrap module.name so the duration of every call is appended to latencies."""
+    original = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process and its children, in MB."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def warm_up():
+    """Import openai, build the shared client and send one query embedding before the timers start,
+    so the first timed call does not pay for them. Returns the number of API calls it made."""
+    from pasqui import module3
+    from pasqui.clients import get_client
+    get_client()
+    module3.embed_queries(["warm-up"])
+    return 1
+
+def paths(work_dir):
+    return {name: os.path.join(work_dir, name) for name in ('input', 'texts', 'embeddings', 'summaries', 'logs')}
+
+def run_stage(stage, work_dir, workers, n_questions, convert_workers=1, packed=False):
+    """Run one stage on the corpus in work_dir and return its measurements."""
+    dirs = paths(work_dir)
+    latencies = []
+    asked = questions[:n_questions]
+    warm_up_calls = 0
+
+    if stage == 'convert':
+        from pasqui import module1
+        items = len(os.listdir(dirs['input']))
+        latency_of = 'document'
+        start = time.perf_counter()
+        if convert_workers == 1:
+            with timed(module1, 'convert_file', latencies):
+                module1.pasqui_converting(dirs['input'], dirs['texts'], os.path.join(dirs['logs'], 'convert.log'))
+        else:  # Files are converted in worker processes, where they cannot be timed one by one
+            module1.pasqui_converting(dirs['input'], dirs['texts'], os.path.join(dirs['logs'], 'convert.log'),
+                                      max_workers=convert_workers)
+
+    elif stage == 'chunk':
+        from pasqui import module2
+        files = sorted(glob.glob(os.path.join(dirs['texts'], '*.txt')))
+        items = len(files)
+        latency_of = 'document'
+        start = time.perf_counter()
+        for path in files:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            begin = time.perf_counter()
+            module2.split_strings_from_subsection((['Section'], text))
+            latencies.append(time.perf_counter() - begin)
+
+    elif stage == 'embed':
+        from pasqui import module2
+        items = len(glob.glob(os.path.join(dirs['texts'], '*.txt')))
+        latency_of = 'request batch'
+        warm_up_calls = warm_up()
+        start = time.perf_counter()
+        with timed(module2, 'embed_texts', latencies):
+            module2.pasqui_embedding(dirs['texts'], dirs['embeddings'], max_workers=workers)
+
+    elif stage == 'load':
+        from pasqui import module3
+        tables = sorted(glob.glob(os.path.join(dirs['embeddings'], '*.csv')))
+        items = len(tables)
+        latency_of = 'document'
+        start = time.perf_counter()
+        for path in tables:
+            begin = time.perf_counter()
+            module3.embedding_norms(module3.load_embeddings(path))
+            latencies.append(time.perf_counter() - begin)
+
+    elif stage == 'retrieve':
+        from pasqui import module3
+        tables = [module3.load_embeddings(path) for path in sorted(glob.glob(os.path.join(dirs['embeddings'], '*.csv')))]
+        items = len(tables)
+        latency_of = 'query'
+        warm_up_calls = warm_up()
+        start = time.perf_counter()
+        for df in tables:
+            for question in asked:
+                begin = time.perf_counter()
+                module3.strings_ranked_by_relatedness(question, df)
+                latencies.append(time.perf_counter() - begin)
+
+    elif stage == 'summarise':
+        from pasqui import module3
+        items = len(glob.glob(os.path.join(dirs['embeddings'], '*.csv')))
+        latency_of = 'document'
+        warm_up_calls = warm_up()
+
+        def pasqui_asks(file_path, questions):
+            begin = time.perf_counter()
+            try:
+                return module3.pasqui_asks(file_path, questions, packed=packed)
+            finally:
+                latencies.append(time.perf_counter() - begin)
+
+        start = time.perf_counter()
+        module3.pasqui_summarising(dirs['embeddings'], dirs['summaries'], asked, [f"Q{i}" for i in range(len(asked))],
+                                   pasqui_asks, os.path.join(dirs['logs'], 'summarise.log'), max_workers=workers)
+
+    elif stage == 'structure':
+        from kor.nodes import Object, Text, Number
+        from pasqui import module4
+        instruction = Object(id="study", description="Details of the study", attributes=[
+            Text(id="topic", description="The main topic of the study"),
+            Number(id="year", description="The year the study was published"),
+        ])
+        items = len(glob.glob(os.path.join(dirs['summaries'], '*.txt')))
+        latency_of = 'document'
+        start = time.perf_counter()
+        with timed(module4, 'extract_file', latencies):
+            module4.pasqui_structuring(dirs['summaries'], os.path.join(work_dir, 'results.xlsx'),
+                                       os.path.join(dirs['logs'], 'structure_errors.log'),
+                                       os.path.join(dirs['logs'], 'structured.log'), ['File', 'topic', 'year'],
+                                       instruction=instruction, max_workers=workers)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {'docs': items, 'seconds': time.perf_counter() - start, 'latencies': latencies,
+            'latency_of': latency_of, 'peak_rss_mb': peak_rss_mb(), 'warm_up_calls': warm_up_calls}
+
+def summarise_stage(measured, calls):
+    """Turn the raw measurements of a stage and its API call counts into the reported row."""
+    latencies = np.array(measured.pop('latencies'))
+    docs = measured['docs']
+    api_calls = calls['embeddings'] + calls['chat'] - measured.pop('warm_up_calls', 0)
+    return dict(
+        measured,
+        docs_per_s=docs / measured['seconds'] if measured['seconds'] else None,
+        p50_ms=float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+        p99_ms=float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+        api_calls=api_calls,
+        api_calls_per_doc=api_calls / docs if docs else None,
+        rate_limited=calls['rate_limited'],
+    )
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def fmt(value, spec):
+    """Format a number with spec, or right-align n/a in the same width."""
+    return format(value, spec) if value is not None else 'n/a'.rjust(int(spec.split('.')[0]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=60)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--formats', nargs='+', choices=['pdf', 'docx', 'txt'], default=['pdf', 'docx', 'txt'])
+    parser.add_argument('--questions', type=int, default=len(questions), choices=range(1, len(questions) + 1))
+    parser.add_argument('--workers', type=int, default=4, help='max_workers passed to the API stages')
+    parser.add_argument('--convert-workers', type=int, default=1,
+                        help='processes converting documents (per-document latency needs 1)')
+    parser.add_argument('--packed', action='store_true', help='summarise with packed multi-question requests')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake server adds to each request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute the fake server allows')
+    parser.add_argument('--dim', type=int, default=256, help='embedding dimensions')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages,
+                        help='stages to run (each needs the outputs of the previous ones)')
+    parser.add_argument('--work-dir', help='where to write the corpus and outputs (default: a temporary directory)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: run a single stage and hand its measurements back on stdout
+    if args.run_stage:
+        result = run_stage(args.run_stage, args.work_dir, args.workers, args.questions, args.convert_workers,
+                           args.packed)
+        print(json.dumps(result))
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pasqui-bench-')
+    dirs = paths(work_dir)
+    for directory in dirs.values():
+        os.makedirs(directory, exist_ok=True)
+
+    # PDF and DOCX documents go through conversion; TXT documents are already text
+    for path in make_corpus(dirs['input'], args.docs, args.pages, args.formats):
+        if path.endswith('.txt'):
+            shutil.move(path, dirs['texts'])
+
+    server = FakeOpenAI(args.latency, args.jitter, args.rpm, args.dim).start()
+    env = dict(os.environ, api_base=server.url, api_key='benchmark')
+    env['PYTHONPATH'] = root + os.pathsep + os.path.join(root, 'src') + os.pathsep + env.get('PYTHONPATH', '')
+
+    results = {'commit': git_commit(), 'config': {k: v for k, v in vars(args).items() if k != 'run_stage'},
+               'stages': {}}
+    print(f"{'stage':<10} {'docs':>6} {'docs/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'latency of':<14} "
+          f"{'RSS MB':>8} {'calls/doc':>9} {'429s':>6}")
+    try:
+        for stage in stages:
+            if stage not in args.stages:
+                continue
+            before = server.snapshot()
+            command = [sys.executable, '-m', 'benchmarks.stages', '--run-stage', stage, '--work-dir', work_dir,
+                       '--workers', str(args.workers), '--questions', str(args.questions),
+                       '--convert-workers', str(args.convert_workers)] + (['--packed'] if args.packed else [])
+            output = subprocess.run(command, env=env, cwd=root, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(output.stderr, file=sys.stderr)
+                raise SystemExit(f"Stage {stage} failed")
+            after = server.snapshot()
+            measured = json.loads(output.stdout.strip().splitlines()[-1])
+            row = summarise_stage(measured, {k: after[k] - before[k] for k in after})
+            results['stages'][stage] = row
+            print(f"{stage:<10} {row['docs']:>6} {fmt(row['docs_per_s'], '9.2f')} {fmt(row['p50_ms'], '9.1f')} "
+                  f"{fmt(row['p99_ms'], '9.1f')} {row['latency_of']:<14} {row['peak_rss_mb']:8.1f} "
+                  f"{fmt(row['api_calls_per_doc'], '9.2f')} {row['rate_limited']:>6}")
+    finally:
+        server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,34 @@
-from .module1 import pasqui_converting
-from .module2 import pasqui_embedding
-from .module3 import pasqui_summarising
-from .module3 import pasqui_asks
-from .module4 import pasqui_structuring
\ No newline at end of file
+import importlib
+
+# Public functions and the submodule defining each. Submodules are only imported when one of
+# their functions is first used, so e.g. pasqui_converting never loads openai or LangChain.
+_exports = {
+    'pasqui_converting': 'module1',
+    'pasqui_deduplicating': 'dedup',
+    'pasqui_embedding': 'module2',
+    'pasqui_summarising': 'module3',
+    'pasqui_asks': 'module3',
+    'pasqui_corpus_asks': 'module3',
+    'pasqui_indexing': 'index',
+    'pasqui_structuring': 'module4',
+    'pasqui_pipeline': 'pipeline',
+    'convert_embeddings_csv': 'store',
+}
+
+# Submodules, also imported on first access (e.g. pasqui.module3.ask)
+_submodules = {'module1', 'module2', 'module3', 'module4', 'store', 'index', 'dedup', 'pipeline',
+               'cache', 'clients', 'ratelimit', 'telemetry', 'tokens', 'workqueue'}
+
+__all__ = list(_exports)
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    if name in _submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | _submodules)
@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Number of keys looked up per SQL statement (SQLite limits bound parameters)
+lookup_batch = 500
+
+def set_journal_mode(conn, wal=False):
+    """Use WAL mode on a SQLite file, or the rollback journal (the default, and the only mode that
+    works on a network filesystem; see workqueue.py). Files left in WAL mode are switched back."""
+    try:
+        conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+    except sqlite3.OperationalError:
+        pass  # Another connection holds the file; it keeps its current mode
+
+def make_key(*parts):
+    """Hash the parts of a request (model, text, ...) into a cache key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class DiskCache:
+    """Size-bounded key/value cache stored in a SQLite file, evicting the least recently used entries.
+
+    With path=None the cache only lives in memory for the current process. The file uses SQLite's
+    rollback journal so it can sit in a folder several machines share; wal=True suits a cache on
+    local disk that many processes read at once.
+    """
+
+    def __init__(self, path=None, max_entries=100000, ttl=None, wal=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path or ':memory:', timeout=60, check_same_thread=False)
+        if path:
+            set_journal_mode(self._conn, wal)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """Return a dict with the cached value of every key found."""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), lookup_batch):
+                batch = keys[start:start + lookup_batch]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT key, value, created FROM cache WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = value
+            if found:
+                self._conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?', [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key, default=None):
+        """Return the cached value of a key, or default."""
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, items):
+        """Store a dict of key -> value (bytes or str), evicting old entries beyond max_entries."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                [(key, value, now, now) for key, value in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def set(self, key, value):
+        """Store a single value."""
+        self.set_many({key: value})
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute('DELETE FROM cache WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries is None:
+            return
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self):
+        """Return hit, miss and entry counts."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,52 @@
+import os
+import threading
+
+gpt = "gpt-4o-mini"
+
+# Clients are created on first use and shared, keyed by the settings they were built with
+_clients = {}
+_llms = {}
+_lock = threading.Lock()
+
+def get_api_key():
+    """Return the API key from the environment, raising if it is not set."""
+    api_key = os.getenv("api_key")  # Get API key from environment
+    if not api_key:
+        raise ValueError("API key is required but not set. Use os.environ['api_key'] = 'your-key' before calling OpenAI functions.")
+    return api_key
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use.
+
+    api_base optionally points it at another OpenAI-compatible server, e.g. a local stub.
+    Retries are left to the request throttles so they count against the rate budgets.
+    """
+    key = (get_api_key(), os.getenv("api_base"))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import openai
+                client = openai.Client(api_key=key[0], base_url=key[1], max_retries=0)
+                _clients[key] = client
+    return client
+
+def get_llm(model=gpt, temperature=0, max_tokens=2000):
+    """Return a shared LangChain chat model, creating it on first use."""
+    key = (get_api_key(), os.getenv("api_base"), model, temperature, max_tokens)
+    llm = _llms.get(key)
+    if llm is None:
+        with _lock:
+            llm = _llms.get(key)
+            if llm is None:
+                from langchain_openai import ChatOpenAI
+                llm = ChatOpenAI(
+                    model_name=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    openai_api_key=key[0],
+                    base_url=key[1],
+                )
+                _llms[key] = llm
+    return llm
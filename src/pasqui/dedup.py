@@ -0,0 +1,221 @@
+import os
+import re
+import zlib
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from .cache import set_journal_mode
+from .workqueue import file_version
+
+# Near-duplicate detection with MinHash signatures and locality-sensitive hashing (LSH):
+#   - a text's signature holds, for num_perm hash permutations, the smallest hash of its word
+#     shingles (runs of shingle_size words); the share of equal positions in two signatures
+#     estimates the Jaccard similarity of their shingle sets
+#   - signatures are cut into bands of rows; texts sharing any band land in the same bucket and
+#     are compared, so a lookup only reads the texts it could duplicate
+# Fingerprinting is linear in the text length. Only canonical texts are bucketed: a duplicate is
+# linked to the canonical text it matched, and its outputs are reused from that one.
+
+num_perm = 128
+bands = 16  # 16 bands of 8 rows: texts above ~0.7 similarity are almost always compared
+shingle_size = 5
+threshold = 0.9  # Estimated Jaccard similarity from which two documents count as duplicates
+signatures_name = ".pasqui_signatures.sqlite"  # Default index file, kept next to the outputs
+
+mersenne_prime = np.uint64((1 << 61) - 1)
+max_hash = np.uint64(0xFFFFFFFF)
+word_pattern = re.compile(r'\w+')
+
+def permutations(count=num_perm, seed=1):
+    """Return the (a, b) coefficients of the hash permutations a * x + b mod 2^61 - 1."""
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, 1 << 32, count, dtype=np.uint64),
+            rng.integers(0, 1 << 32, count, dtype=np.uint64))
+
+_a, _b = permutations()
+
+def text_digest(text):
+    """Return a hash of a text's lower-cased words, equal for texts differing only in case, spacing or punctuation."""
+    return hashlib.sha256(' '.join(word_pattern.findall(text.lower())).encode('utf-8')).hexdigest()
+
+def shingle_hashes(text, size=shingle_size):
+    """Return the distinct 32-bit hashes of every run of size consecutive words."""
+    words = word_pattern.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64, count=len(words))
+    size = min(size, len(words))
+    count = len(words) - size + 1
+    combined = np.zeros(count, dtype=np.uint64)
+    for j in range(size):
+        combined = combined * np.uint64(1000003) + hashes[j:j + count]  # Wraps around mod 2^64
+    return np.unique((combined >> np.uint64(32)) ^ (combined & max_hash))
+
+def minhash(text, block=4096):
+    """Return the MinHash signature of a text (num_perm uint32), or None for a text without words."""
+    shingles = shingle_hashes(text)
+    if len(shingles) == 0:
+        return None
+    signature = np.full(num_perm, max_hash, dtype=np.uint64)
+    for start in range(0, len(shingles), block):
+        # Hashes and coefficients are below 2^32, so a * x + b never overflows 64 bits
+        values = (np.outer(shingles[start:start + block], _a) + _b) % mersenne_prime & max_hash
+        signature = np.minimum(signature, values.min(axis=0))
+    return signature.astype(np.uint32)
+
+def similarity(a, b):
+    """Return the Jaccard similarity estimated from two signatures."""
+    return float(np.mean(a == b))
+
+class SignatureIndex:
+    """Persistent MinHash/LSH index linking every text to the canonical text it duplicates.
+
+    Texts of one kind ('document' or 'chunk') are only compared with each other. The first of a
+    group of duplicates to be added is the canonical one; texts are re-fingerprinted only when
+    their version changes. Like DiskCache, the file uses the rollback journal unless wal=True.
+    """
+
+    def __init__(self, path=None, kind='document', threshold=threshold, wal=False):
+        self.path = path
+        self.kind = kind
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path or ':memory:', timeout=60, check_same_thread=False)
+        if path:
+            set_journal_mode(self._conn, wal)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS texts (
+                kind TEXT, name TEXT, version TEXT, digest TEXT, signature BLOB, canonical TEXT,
+                similarity REAL, PRIMARY KEY (kind, name));
+            CREATE INDEX IF NOT EXISTS texts_digest ON texts (kind, digest);
+            CREATE INDEX IF NOT EXISTS texts_canonical ON texts (kind, canonical);
+            CREATE TABLE IF NOT EXISTS buckets (kind TEXT, band INTEGER, bucket BLOB, name TEXT);
+            CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (kind, band, bucket);
+            CREATE INDEX IF NOT EXISTS buckets_name ON buckets (kind, name);
+        ''')
+        self._conn.commit()
+
+    def _bands(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(bands)]
+
+    def _match(self, digest, signature):
+        """Return (canonical name, similarity) of the best canonical text matching, or (None, 0.0)."""
+        row = self._conn.execute('SELECT name FROM texts WHERE kind = ? AND digest = ? AND canonical IS NULL',
+                                 (self.kind, digest)).fetchone()
+        if row:
+            return row[0], 1.0
+        if signature is None:
+            return None, 0.0
+        candidates = set()
+        for band, bucket in self._bands(signature):
+            rows = self._conn.execute('SELECT name FROM buckets WHERE kind = ? AND band = ? AND bucket = ?',
+                                      (self.kind, band, bucket)).fetchall()
+            candidates.update(name for (name,) in rows)
+        best, best_similarity = None, 0.0
+        for name in sorted(candidates):
+            (stored,) = self._conn.execute('SELECT signature FROM texts WHERE kind = ? AND name = ?',
+                                           (self.kind, name)).fetchone()
+            value = similarity(signature, np.frombuffer(stored, dtype=np.uint32))
+            if value >= self.threshold and value > best_similarity:
+                best, best_similarity = name, value
+        return best, best_similarity
+
+    def _remove(self, name):
+        """Forget a text; duplicates linked to it are forgotten too, so they are matched again when re-added."""
+        self._conn.execute('DELETE FROM buckets WHERE kind = ? AND name = ?', (self.kind, name))
+        self._conn.execute('DELETE FROM texts WHERE kind = ? AND (name = ? OR canonical = ?)',
+                           (self.kind, name, name))
+
+    def add(self, name, text, version=None):
+        """Fingerprint a text and return (canonical name, similarity) if it duplicates an earlier one, else (None, 0.0).
+
+        A text already indexed with the same version is not fingerprinted again.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT version, canonical, similarity FROM texts WHERE kind = ? AND name = ?',
+                                     (self.kind, name)).fetchone()
+            if row and version is not None and row[0] == version:
+                return (row[1], row[2]) if row[1] else (None, 0.0)
+
+        # Fingerprint outside the lock, other threads keep using the index meanwhile
+        digest = text_digest(text)
+        signature = minhash(text)
+
+        with self._lock:
+            self._remove(name)
+            canonical, value = self._match(digest, signature)
+            self._conn.execute('INSERT INTO texts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (self.kind, name, version, digest,
+                                None if signature is None else signature.tobytes(), canonical, value))
+            if canonical is None and signature is not None:
+                self._conn.executemany('INSERT INTO buckets VALUES (?, ?, ?, ?)',
+                                       [(self.kind, band, bucket, name) for band, bucket in self._bands(signature)])
+            self._conn.commit()
+        return canonical, value
+
+    def version(self, name):
+        """Return the version a text was last fingerprinted at, or None if it is not indexed."""
+        with self._lock:
+            row = self._conn.execute('SELECT version FROM texts WHERE kind = ? AND name = ?',
+                                     (self.kind, name)).fetchone()
+        return row[0] if row else None
+
+    def canonical(self, name):
+        """Return (canonical name, similarity) of an indexed duplicate, else (None, 0.0)."""
+        with self._lock:
+            row = self._conn.execute('SELECT canonical, similarity FROM texts WHERE kind = ? AND name = ?',
+                                     (self.kind, name)).fetchone()
+        return (row[0], row[1]) if row and row[0] else (None, 0.0)
+
+    def duplicates(self):
+        """Return a dict of duplicate name -> (canonical name, similarity)."""
+        with self._lock:
+            rows = self._conn.execute('SELECT name, canonical, similarity FROM texts '
+                                      'WHERE kind = ? AND canonical IS NOT NULL ORDER BY name', (self.kind,)).fetchall()
+        return {name: (canonical, value) for name, canonical, value in rows}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM texts WHERE kind = ?', (self.kind,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def document_name(path):
+    """Return the name a document is indexed under: its file name without extension, shared by its
+    converted text (.txt) and embeddings table (.csv)."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+def pasqui_deduplicating(folder_path, signatures_path=None, threshold=threshold):
+    """Fingerprint every converted text of folder_path and link exact and near duplicates to a canonical one.
+
+    The index is kept in folder_path unless signatures_path is given; pass the same path to
+    pasqui_embedding and pasqui_summarising (deduplicate=True) to reuse the canonical outputs.
+    Returns a dict of duplicate name -> (canonical name, similarity).
+    """
+    index = SignatureIndex(signatures_path or os.path.join(folder_path, signatures_name), threshold=threshold)
+    files = sorted(f for f in os.listdir(folder_path) if f.endswith('.txt'))
+    try:
+        for file_name in files:
+            path = os.path.join(folder_path, file_name)
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    text = file.read()
+                index.add(document_name(path), text, version=file_version(path))
+            except Exception as e:
+                print(f"Error fingerprinting {path}: {e}")
+        names = {document_name(f) for f in files}
+        duplicates = {name: link for name, link in index.duplicates().items() if name in names}
+    finally:
+        index.close()
+
+    exact = sum(1 for _, value in duplicates.values() if value == 1.0)
+    canonical = len({canonical for canonical, _ in duplicates.values()})
+    print(f"Fingerprinted {len(files)} documents: {exact} exact and {len(duplicates) - exact} near duplicates "
+          f"of {canonical} canonical documents")
+    return duplicates
@@ -0,0 +1,378 @@
+import os
+import shutil
+import sqlite3
+import numpy as np
+from . import store
+
+# Layout of an index directory:
+#   index.sqlite       -> documents, chunk texts and the (list, row) where each vector lives
+#   lists-<gen>/<n>.f32 -> float32 unit vectors of inverted list n, appended row by row
+#   lists-<gen>/<n>.doc -> int64 document id of every row of list n
+#   centroids-<gen>.npy -> coarse quantizer (absent until trained: everything lives in list 0)
+# Every file is memory-mapped for search. Training and compaction write a new generation and
+# switch to it in one SQLite transaction, so a crash leaves the previous generation intact.
+
+def normalize(matrix):
+    """Return float32 rows scaled to unit length (zero rows are left as they are)."""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def top_k(scores, k):
+    """Return the indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    indices = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind='stable')]
+
+class CorpusIndex:
+    """Persistent inverted-file (IVF) vector index over the chunks of every document of a corpus.
+
+    Documents are added, replaced and deleted incrementally. Until train() is called all vectors
+    share one list and search is exact; afterwards each query only scans its nprobe closest lists.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(index_dir, 'index.sqlite'), timeout=60)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS documents (
+                doc INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, version TEXT, deleted INTEGER DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS documents_name ON documents (name);
+            CREATE TABLE IF NOT EXISTS chunks (
+                list INTEGER, row INTEGER, doc INTEGER, text TEXT, PRIMARY KEY (list, row));
+            CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc);
+        ''')
+        self._conn.commit()
+        self._maps = {}
+        self._load_meta()
+        self._load_deleted()
+
+    # Metadata -----------------------------------------------------------------------------
+
+    def _get_meta(self, key, default=None):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _load_meta(self):
+        dim = self._get_meta('dim')
+        self.dim = int(dim) if dim else None
+        self.generation = int(self._get_meta('generation', 0))
+        self.lists_dir = os.path.join(self.index_dir, f'lists-{self.generation}')
+        os.makedirs(self.lists_dir, exist_ok=True)
+        centroids_path = os.path.join(self.index_dir, f'centroids-{self.generation}.npy')
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+        self.nlist = 1 if self.centroids is None else len(self.centroids)
+        self._maps.clear()
+
+    def _load_deleted(self):
+        rows = self._conn.execute('SELECT doc FROM documents WHERE deleted = 1').fetchall()
+        self._deleted = np.array([doc for (doc,) in rows], dtype=np.int64)
+
+    def documents(self):
+        """Return a dict of live document name -> version."""
+        return dict(self._conn.execute('SELECT name, version FROM documents WHERE deleted = 0'))
+
+    def __len__(self):
+        """Number of live chunks."""
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM chunks JOIN documents USING (doc) WHERE deleted = 0').fetchone()[0]
+
+    def dead_rows(self):
+        """Number of rows in the lists that compact() would reclaim (deleted or replaced documents)."""
+        return sum(self._rows(n) for n in range(self.nlist)) - len(self) if self.dim else 0
+
+    # Inverted lists -----------------------------------------------------------------------
+
+    def _paths(self, list_no, lists_dir=None):
+        base = os.path.join(lists_dir or self.lists_dir, str(list_no))
+        return base + '.f32', base + '.doc'
+
+    def _rows(self, list_no, lists_dir=None):
+        vec_path, doc_path = self._paths(list_no, lists_dir)
+        if not os.path.exists(doc_path) or not os.path.exists(vec_path):
+            return 0
+        return min(os.path.getsize(vec_path) // (4 * self.dim), os.path.getsize(doc_path) // 8)
+
+    def _list(self, list_no):
+        """Return the (vectors, document ids) of a list as memory maps."""
+        rows = self._rows(list_no)
+        cached = self._maps.get(list_no)
+        if cached is not None and len(cached[1]) == rows:
+            return cached
+        if rows == 0:
+            arrays = (np.empty((0, self.dim or 0), dtype=np.float32), np.empty(0, dtype=np.int64))
+        else:
+            vec_path, doc_path = self._paths(list_no)
+            arrays = (np.memmap(vec_path, dtype=np.float32, mode='r', shape=(rows, self.dim)),
+                      np.memmap(doc_path, dtype=np.int64, mode='r', shape=(rows,)))
+        self._maps[list_no] = arrays
+        return arrays
+
+    def _append(self, list_no, vectors, docs, lists_dir=None):
+        """Append rows to a list and return the row number of the first one."""
+        vec_path, doc_path = self._paths(list_no, lists_dir)
+        start = self._rows(list_no, lists_dir)
+        # Drop a partial row left by a crash in the middle of an earlier append
+        for path, row_size in ((vec_path, 4 * self.dim), (doc_path, 8)):
+            if os.path.exists(path) and os.path.getsize(path) != start * row_size:
+                os.truncate(path, start * row_size)
+        with open(vec_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(doc_path, 'ab') as f:
+            f.write(np.asarray(docs, dtype=np.int64).tobytes())
+        if lists_dir is None:
+            self._maps.pop(list_no, None)
+        return start
+
+    def _assign(self, vectors, centroids=None):
+        """Return the list of every vector (the closest centroid)."""
+        centroids = self.centroids if centroids is None else centroids
+        if centroids is None:
+            return np.zeros(len(vectors), dtype=np.int64)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), 65536):
+            block = vectors[start:start + 65536]
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    # Updates ------------------------------------------------------------------------------
+
+    def add_document(self, name, texts, embeddings, version=None):
+        """Add a document's chunks, replacing any live document with the same name."""
+        vectors = normalize(embeddings)
+        if len(texts) != len(vectors):
+            raise ValueError(f"{name}: {len(texts)} texts but {len(vectors)} embeddings")
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._set_meta('dim', self.dim)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"{name}: embeddings have {vectors.shape[1]} dimensions, the index has {self.dim}")
+
+        # The document stays marked deleted until all its rows are written, so rows left by a
+        # crash half-way through are never returned
+        self.delete_document(name)
+        doc = self._conn.execute(
+            'INSERT INTO documents (name, version, deleted) VALUES (?, ?, 1)', (name, version)).lastrowid
+        self._conn.commit()
+
+        lists = self._assign(vectors)
+        chunk_rows = []
+        for list_no in np.unique(lists):
+            selected = np.nonzero(lists == list_no)[0]
+            start = self._append(int(list_no), vectors[selected], np.full(len(selected), doc))
+            chunk_rows.extend((int(list_no), start + j, doc, texts[i]) for j, i in enumerate(selected))
+        self._conn.executemany('INSERT INTO chunks (list, row, doc, text) VALUES (?, ?, ?, ?)', chunk_rows)
+        self._conn.execute('UPDATE documents SET deleted = 0 WHERE doc = ?', (doc,))
+        self._conn.commit()
+        self._load_deleted()
+
+    def delete_document(self, name):
+        """Delete a document; its rows are skipped by search until compact() reclaims them."""
+        self._conn.execute('UPDATE documents SET deleted = 1 WHERE name = ? AND deleted = 0', (name,))
+        self._conn.commit()
+        self._load_deleted()
+
+    def train(self, nlist=None, sample_size=100000, iterations=10, seed=0):
+        """Cluster the vectors into nlist inverted lists (spherical k-means) and rebuild the index."""
+        rng = np.random.default_rng(seed)
+        total = sum(self._rows(n) for n in range(self.nlist))
+        if total == 0:
+            return
+        if nlist is None:
+            nlist = int(4 * np.sqrt(total))
+        nlist = max(1, min(nlist, total))
+
+        # Sample live vectors uniformly across lists
+        fraction = min(1.0, sample_size / total)
+        samples = []
+        for list_no in range(self.nlist):
+            vectors, docs = self._list(list_no)
+            keep = (rng.random(len(vectors)) < fraction) & ~np.isin(docs, self._deleted)
+            samples.append(np.asarray(vectors[keep]))
+        sample = np.concatenate(samples) if samples else np.empty((0, self.dim), dtype=np.float32)
+        if len(sample) < nlist:
+            nlist = max(1, len(sample))
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]  # Re-seed empty clusters
+            centroids = normalize(sums)
+
+        self._rebuild(centroids)
+
+    def compact(self):
+        """Rewrite the lists without the rows of deleted documents."""
+        self._rebuild(self.centroids)
+
+    def _rebuild(self, centroids):
+        generation = self.generation + 1
+        lists_dir = os.path.join(self.index_dir, f'lists-{generation}')
+        shutil.rmtree(lists_dir, ignore_errors=True)
+        os.makedirs(lists_dir)
+
+        remap = []  # (old list, old row, new list, new row)
+        for list_no in range(self.nlist):
+            vectors, docs = self._list(list_no)
+            for start in range(0, len(vectors), 65536):
+                block, block_docs = vectors[start:start + 65536], docs[start:start + 65536]
+                live = np.nonzero(~np.isin(block_docs, self._deleted))[0]
+                assignments = self._assign(np.asarray(block[live]), centroids)
+                for new_list in np.unique(assignments):
+                    selected = live[assignments == new_list]
+                    first = self._append(int(new_list), block[selected], block_docs[selected], lists_dir)
+                    remap.extend((list_no, start + int(old), int(new_list), first + j)
+                                 for j, old in enumerate(selected))
+
+        if centroids is not None:
+            np.save(os.path.join(self.index_dir, f'centroids-{generation}.npy'), centroids)
+
+        # Switch chunks, deleted documents and the generation in one transaction
+        conn = self._conn
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS remap (old_list INTEGER, old_row INTEGER, new_list INTEGER, new_row INTEGER)')
+        conn.execute('DELETE FROM remap')
+        conn.executemany('INSERT INTO remap VALUES (?, ?, ?, ?)', remap)
+        conn.execute('CREATE INDEX IF NOT EXISTS temp.remap_old ON remap (old_list, old_row)')
+        conn.execute('CREATE TABLE chunks_new (list INTEGER, row INTEGER, doc INTEGER, text TEXT, PRIMARY KEY (list, row))')
+        conn.execute('''INSERT INTO chunks_new SELECT r.new_list, r.new_row, c.doc, c.text
+                        FROM chunks c JOIN remap r ON c.list = r.old_list AND c.row = r.old_row''')
+        conn.execute('DROP TABLE chunks')
+        conn.execute('ALTER TABLE chunks_new RENAME TO chunks')
+        conn.execute('CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc)')
+        conn.execute('DELETE FROM documents WHERE deleted = 1')
+        self._set_meta('generation', generation)
+        conn.commit()
+        conn.execute('DROP TABLE remap')
+
+        old_generation = self.generation
+        self._load_meta()
+        self._load_deleted()
+        shutil.rmtree(os.path.join(self.index_dir, f'lists-{old_generation}'), ignore_errors=True)
+        old_centroids = os.path.join(self.index_dir, f'centroids-{old_generation}.npy')
+        if os.path.exists(old_centroids):
+            os.remove(old_centroids)
+
+    # Search -------------------------------------------------------------------------------
+
+    def search(self, query_embeddings, k=20, documents=None, nprobe=8):
+        """Return, for every query, up to k (document, text, relatedness) tuples, best first.
+
+        documents restricts the search to those document names; their lists are then all
+        scanned, so filtered searches are exact.
+        """
+        queries = normalize(query_embeddings)
+        if self.dim is None:
+            return [[] for _ in queries]
+
+        allowed = None
+        if documents is not None:
+            names = list(documents)
+            placeholders = ','.join('?' * len(names))
+            allowed = np.array([doc for (doc,) in self._conn.execute(
+                f'SELECT doc FROM documents WHERE deleted = 0 AND name IN ({placeholders})', names)], dtype=np.int64)
+            if len(allowed) == 0:
+                return [[] for _ in queries]
+            lists = [n for (n,) in self._conn.execute(
+                f'SELECT DISTINCT list FROM chunks WHERE doc IN ({",".join("?" * len(allowed))})',
+                allowed.tolist())]
+            probes = {n: np.arange(len(queries)) for n in lists}
+        elif self.centroids is None:
+            probes = {0: np.arange(len(queries))}
+        else:
+            closest = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+            probes = {}
+            for q, lists in enumerate(closest):
+                for n in lists:
+                    probes.setdefault(int(n), []).append(q)
+
+        best_scores = [np.empty(0, dtype=np.float32) for _ in queries]
+        best_refs = [np.empty((0, 2), dtype=np.int64) for _ in queries]
+        for list_no, query_ids in probes.items():
+            vectors, docs = self._list(list_no)
+            if len(vectors) == 0:
+                continue
+            query_ids = np.asarray(query_ids)
+            scores = queries[query_ids] @ vectors.T
+            excluded = np.isin(docs, self._deleted) if len(self._deleted) else None
+            if allowed is not None:
+                outside = ~np.isin(docs, allowed)
+                excluded = outside if excluded is None else excluded | outside
+            if excluded is not None:
+                scores[:, excluded] = -np.inf
+            for q, row_scores in zip(query_ids, scores):
+                top = top_k(row_scores, k)
+                top = top[np.isfinite(row_scores[top])]
+                refs = np.column_stack([np.full(len(top), list_no), top])
+                merged_scores = np.concatenate([best_scores[q], row_scores[top]])
+                merged_refs = np.concatenate([best_refs[q], refs])
+                keep = top_k(merged_scores, k)
+                best_scores[q], best_refs[q] = merged_scores[keep], merged_refs[keep]
+
+        results = []
+        for scores, refs in zip(best_scores, best_refs):
+            hits = []
+            for score, (list_no, row) in zip(scores, refs):
+                found = self._conn.execute(
+                    'SELECT d.name, c.text FROM chunks c JOIN documents d USING (doc) WHERE c.list = ? AND c.row = ?',
+                    (int(list_no), int(row))).fetchone()
+                if found:
+                    hits.append((found[0], found[1], float(score)))
+            results.append(hits)
+        return results
+
+    def close(self):
+        self._conn.close()
+
+def pasqui_indexing(embeddings_dir, index_dir, nlist=None, train_threshold=10000, compact_threshold=0.2):
+    """Sync a corpus index with the outputs of pasqui_embedding and return it; the caller must close it.
+
+    New and modified documents are (re)added, documents no longer in embeddings_dir are deleted.
+    The index is trained once it holds train_threshold chunks, and compacted once the rows left by
+    modified or deleted documents exceed compact_threshold of its rows.
+    """
+    index = CorpusIndex(index_dir)
+    indexed = index.documents()
+    files = sorted(f for f in os.listdir(embeddings_dir) if f.endswith('.csv'))
+    added = 0
+
+    for file_name in files:
+        table_path = os.path.join(embeddings_dir, file_name)
+        matrix_path = store.matrix_path(table_path)
+        version = str(os.path.getmtime(matrix_path if os.path.exists(matrix_path) else table_path))
+        if indexed.get(file_name) == version:
+            continue
+        try:
+            df = store.load_embeddings(table_path)
+            if len(df) == 0:
+                continue
+            matrix = store.frame_data(df).get('embedding_matrix')
+            if matrix is None:
+                matrix = np.vstack(df['embedding'].to_numpy())
+            index.add_document(file_name, df['text'].tolist(), matrix, version=version)
+            added += 1
+        except Exception as e:
+            print(f"Error indexing {table_path}: {e}")
+
+    removed = set(indexed) - set(files)
+    for name in removed:
+        index.delete_document(name)
+
+    live, dead = len(index), index.dead_rows()
+    if index.centroids is None and live >= train_threshold:
+        index.train(nlist)
+    elif dead and dead > compact_threshold * (live + dead):
+        index.compact()
+
+    print(f"Indexed {added} documents, removed {len(removed)}: {len(index)} chunks in {index.nlist} lists")
+    return index
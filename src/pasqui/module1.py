@@ -1,24 +1,95 @@
 import os
+import json
+import signal
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pdfplumber
 from docx import Document
+from . import telemetry
+from .workqueue import LeaseQueue, temporary_path, file_version, stage_key
+
+# Name of the manifest kept in output_dir to skip unchanged files on later runs
+manifest_name = '.pasqui_manifest.json'
 
 # Function to ensure output directory exists
 def create_output_directory(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+class PageTimeout(Exception):
+    """Raised when extracting a single PDF page takes longer than the allowed time."""
+
+# Context manager to interrupt a page after `seconds`. It relies on SIGALRM, so the limit
+# only applies on Unix in the main thread of a process (e.g. in pasqui_converting's workers).
+@contextmanager
+def page_time_limit(seconds):
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise PageTimeout(f"page took longer than {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+# Generator yielding the text of a PDF page by page. page_range is a 1-based inclusive
+# (first, last) tuple; pages that fail or time out are appended to `skipped` as (page, reason).
+def iter_pdf_pages(pdf_path, page_range=None, page_timeout=None, skipped=None):
+    with pdfplumber.open(pdf_path) as pdf:
+        first, last = page_range or (1, None)
+        last = len(pdf.pages) if last is None else min(last, len(pdf.pages))
+        for number in range(max(first, 1), last + 1):
+            page = pdf.pages[number - 1]
+            try:
+                with page_time_limit(page_timeout):
+                    text = page.extract_text() or ''
+            except Exception as e:
+                if skipped is not None:
+                    skipped.append((number, str(e) or type(e).__name__))
+                text = ''
+            finally:
+                page.close()  # Release the page's parsed layout objects
+            yield text
+
 # Function to extract text from PDF files
-def extract_text_from_pdf(pdf_path):
+def extract_text_from_pdf(pdf_path, page_range=None, page_timeout=None):
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            text = ''
-            for page in pdf.pages:
-                text += page.extract_text() or ''
-        return text
-    except pdfplumber.utils.PDFSyntaxError:
-        print(f"Error: Could not process {pdf_path} - Skipping this file.")
+        return ''.join(iter_pdf_pages(pdf_path, page_range, page_timeout))
+    except Exception as e:
+        logging.error(f"Error: Could not process {pdf_path} - {str(e)}")
         return None
 
+# Function to stream the text of a PDF into output_path page by page.
+# Returns the list of skipped pages, or None if no text could be extracted.
+def extract_pdf_to_file(pdf_path, output_path, page_range=None, page_timeout=None):
+    skipped = []
+    written = 0
+    tmp_path = temporary_path(output_path)
+    try:
+        with open(tmp_path, 'w') as file:
+            for text in iter_pdf_pages(pdf_path, page_range, page_timeout, skipped):
+                file.write(text)
+                written += len(text)
+    except Exception as e:
+        logging.error(f"Error: Could not process {pdf_path} - {str(e)}")
+        written = 0
+
+    if not written:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, output_path)
+    return skipped
+
 # Function to extract text from DOCX files
 def extract_text_from_docx(docx_path):
     try:
@@ -28,46 +99,178 @@ def extract_text_from_docx(docx_path):
             text += para.text + '\n'
         return text
     except Exception as e:
-        print(f"Error: Could not process {docx_path} - {str(e)}")
+        logging.error(f"Error: Could not process {docx_path} - {str(e)}")
         return None
 
-# Function to write text to file
+# Function to write text to file, replacing it atomically
 def save_text_to_file(text, output_path):
-    with open(output_path, 'w') as file:
+    tmp_path = temporary_path(output_path)
+    with open(tmp_path, 'w') as file:
         file.write(text)
+    os.replace(tmp_path, output_path)
 
 # Function to log errors
 def log_error(error_log, message):
     error_log.write(message + '\n')
 
-# Function to process files
-def pasqui_converting(input_dir, output_dir, error_log_path):
-    create_output_directory(output_dir)
+# Function to hash a file's content
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-    with open(error_log_path, 'w') as error_log:
-        for filename in os.listdir(input_dir):
-            file_path = os.path.join(input_dir, filename)
+# Function to load the manifest of converted files (filename -> size, mtime, sha256, output)
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, manifest_name)
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            return json.load(file)
+    return {}
+
+# Function to save the manifest atomically
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, manifest_name)
+    tmp_path = temporary_path(path)
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, path)
 
+# Function to check whether a file is unchanged since it was last converted
+def is_unchanged(file_path, output_dir, stat, entry):
+    if not entry or entry['size'] != stat.st_size:
+        return False
+    if not os.path.exists(os.path.join(output_dir, entry['output'])):
+        return False
+    if entry['mtime'] == stat.st_mtime:
+        return True
+    # Touched but maybe not modified: compare the content hash
+    return entry['sha256'] == file_hash(file_path)
+
+# Function to convert a single PDF or DOCX file.
+# Returns (filename, output_path or None, sha256, skipped PDF pages).
+# Its time is recorded in telemetry when enabled in this process.
+def convert_file(file_path, output_dir, page_range=None, page_timeout=None):
+    filename = os.path.basename(file_path)
+    with telemetry.scope(stage='convert', document=filename), telemetry.timer('pasqui_document_seconds'):
+        try:
             if filename.endswith('.pdf'):
-                extracted_text = extract_text_from_pdf(file_path)
-                if extracted_text:
-                    output_path = os.path.join(output_dir, filename.replace('.pdf', '.txt'))
-                    save_text_to_file(extracted_text, output_path)
-                    print(f"Text extracted from {filename} and saved to {output_path}")
-                else:
-                    log_error(error_log, f"Could not process: {filename}")
-                    print(f"Skipping {filename} due to an error.")
-
-            elif filename.endswith('.docx'):
-                extracted_text = extract_text_from_docx(file_path)
-                if extracted_text:
-                    output_path = os.path.join(output_dir, filename.replace('.docx', '.txt'))
-                    save_text_to_file(extracted_text, output_path)
-                    print(f"Text extracted from {filename} and saved to {output_path}")
-                else:
-                    log_error(error_log, f"Could not process: {filename}")
-                    print(f"Skipping {filename} due to an error.")
+                # PDFs are streamed to disk page by page to keep memory bounded
+                output_path = os.path.join(output_dir, filename.replace('.pdf', '.txt'))
+                skipped = extract_pdf_to_file(file_path, output_path, page_range, page_timeout)
+                if skipped is None:
+                    return filename, None, None, []
+                return filename, output_path, file_hash(file_path), skipped
+
+            extracted_text = extract_text_from_docx(file_path)
+            if not extracted_text:
+                return filename, None, None, []
+            output_path = os.path.join(output_dir, filename.replace('.docx', '.txt'))
+            save_text_to_file(extracted_text, output_path)
+            return filename, output_path, file_hash(file_path), []
+        except Exception as e:
+            logging.error(f"Error: Could not process {file_path} - {str(e)}")
+            return filename, None, None, []
+
+# Function to process files. Unchanged files recorded in the manifest are skipped when
+# incremental is True; max_workers > 1 converts in a process pool (None uses every core).
+# page_range and page_timeout limit PDF extraction; skipped pages are written to the error log.
+# With work_queue (a SQLite file, see workqueue.py) several processes or machines can convert the
+# same input_dir: each claims files from the queue, whose results make the manifest once all are done.
+# Without incremental the files already done are converted again, once per run: pass the workers the
+# same run_id, or a worker started after the others finished begins a new run (see LeaseQueue.enqueue).
+def pasqui_converting(input_dir, output_dir, error_log_path, max_workers=1, incremental=True,
+                      page_range=None, page_timeout=None, work_queue=None, lease_seconds=300, run_id=None):
+    create_output_directory(output_dir)
+    manifest = load_manifest(output_dir) if incremental else {}
+    converted = {}  # Manifest entries written by this run
+
+    # Append so the history of failures from earlier runs is kept
+    with open(error_log_path, 'a') as error_log:
+        pending = {}
+        for filename in sorted(os.listdir(input_dir)):
+            file_path = os.path.join(input_dir, filename)
 
+            if filename.endswith(('.pdf', '.docx')):
+                stat = os.stat(file_path)
+                if incremental and is_unchanged(file_path, output_dir, stat, manifest.get(filename)):
+                    manifest[filename]['mtime'] = stat.st_mtime
+                    telemetry.count('pasqui_documents_total', stage='convert', status='unchanged')
+                    continue
+                pending[filename] = stat
             else:
                 log_error(error_log, f"Unsupported file type: {filename}")
-                print(f"Unsupported file type: {filename}")
+                logging.warning(f"Unsupported file type: {filename}")
+
+        print(f"{len(pending)} files to convert")
+
+        def record(result):
+            filename, output_path, sha256, skipped = result
+            for page, reason in skipped:
+                log_error(error_log, f"Skipped page {page} of {filename}: {reason}")
+            telemetry.count('pasqui_pages_skipped_total', len(skipped), stage='convert', document=filename)
+            if output_path:
+                # Files claimed from the queue may have been listed by another worker only
+                stat = pending.get(filename) or os.stat(os.path.join(input_dir, filename))
+                manifest[filename] = converted[filename] = {
+                    'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256,
+                    'output': os.path.basename(output_path)}
+                telemetry.count('pasqui_documents_total', stage='convert', status='done')
+                logging.info(f"Text extracted from {filename} and saved to {output_path}")
+            else:
+                manifest.pop(filename, None)
+                log_error(error_log, f"Could not process: {filename}")
+                telemetry.count('pasqui_documents_total', stage='convert', status='failed')
+                logging.error(f"Skipping {filename} due to an error.")
+
+        paths = [os.path.join(input_dir, filename) for filename in pending]
+        if work_queue:
+            queue = LeaseQueue(work_queue, lease_seconds=lease_seconds)
+            executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+            batch_size = 1 if executor is None else (max_workers or os.cpu_count() or 1) * 2
+            try:
+                stage = stage_key('convert', os.path.abspath(output_dir), page_range, page_timeout)
+                for leases in queue.batches(stage, [(os.path.basename(p), file_version(p)) for p in paths],
+                                            batch_size, redo=not incremental, run=run_id):
+                    claimed = [os.path.join(input_dir, lease.name) for lease in leases]
+                    if executor is None:
+                        results = [convert_file(path, output_dir, page_range, page_timeout) for path in claimed]
+                    else:
+                        futures = [executor.submit(convert_file, path, output_dir, page_range, page_timeout)
+                                   for path in claimed]
+                        results = [future.result() for future in futures]
+                    for lease, result in zip(leases, results):
+                        record(result)
+                        if result[1]:
+                            # The manifest entry is the task's artefact, merged into the manifest below
+                            queue.complete(lease, json.dumps(converted[lease.name]))
+                        else:
+                            queue.fail(lease, f"Could not process: {lease.name}")
+
+                # Every task is done or failed: each worker writes the same manifest, built from
+                # the queue rather than from what the other workers saved
+                manifest = load_manifest(output_dir) if incremental else {}
+                manifest.update((name, json.loads(entry)) for name, entry in queue.results(stage).items())
+                for name in queue.results(stage, 'failed'):
+                    manifest.pop(name, None)
+                save_manifest(output_dir, manifest)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+                queue.close()
+            return
+        if max_workers == 1:
+            for done, path in enumerate(paths, 1):
+                record(convert_file(path, output_dir, page_range, page_timeout))
+                if done % 100 == 0:
+                    save_manifest(output_dir, manifest)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(convert_file, path, output_dir, page_range, page_timeout) for path in paths]
+                for done, future in enumerate(as_completed(futures), 1):
+                    record(future.result())
+                    if done % 100 == 0:
+                        save_manifest(output_dir, manifest)
+
+        save_manifest(output_dir, manifest)
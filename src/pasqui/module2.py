@@ -1,100 +1,450 @@
 import os
-import pandas as pd
-import openai
-import tiktoken
-from openai import Client
 import numpy as np
-from scipy import spatial  # for calculating vector similarities for search
-from docx import Document
 import logging
 import re
+from collections import deque
+from . import tokens, telemetry, dedup
+from .clients import get_client
+from .cache import DiskCache, make_key
+from .ratelimit import RequestThrottle, map_ordered
+from .workqueue import LeaseQueue, file_version, stage_key
+from .store import save_embeddings, matrix_path, copy_embeddings, load_token_counts
 gpt = "gpt-4o-mini" #module3 is for summarising. Sorry for the shitty names.
 em = "text-embedding-3-small"
-# Ensure API key is set
-api_key = os.getenv("api_key")  # Retrieve from environment
-if not api_key:
-    raise ValueError("API key is required but not set. Use os.environ['OPENAI_API_KEY'] = 'your-key' before running the script.")
+cache_name = ".pasqui_embeddings.sqlite"  # Default chunk-embedding cache, kept in the output folder
+request_tokens = 100000  # Tokens packed into one embeddings request (the API allows 300k and 2048 inputs)
 
-# Initialize OpenAI client
-client = openai.Client(api_key=api_key)
+# The OpenAI client is created on first use (see clients.get_client), so importing this
+# module needs neither the API key nor the openai package to be loaded.
+def __getattr__(name):
+    if name == 'client':
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Function to return the number of tokens in a string
-def num_tokens(text, model=gpt):
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+# Limits shared by every embeddings request (in-flight count, per-minute budgets, retries)
+throttle = RequestThrottle()
+
+# Function to return the number of tokens in a string (the encoding is loaded once per model)
+num_tokens = tokens.num_tokens
+
+# A sentence is the text up to and including its sentence-ending punctuation and the line breaks
+# right after it, which the tokenizer encodes together with the punctuation
+sentence_pattern = re.compile(r'[^.!?]+[.!?]?[\r\n]*|[.!?][\r\n]*')
+
+# Generator yielding (chunk, token count) pairs of at most max_tokens tokens, split by sentences.
+# Every sentence is encoded once and chunks are built from running per-sentence token counts;
+# consecutive chunks share up to overlap_tokens tokens of whole sentences. Chunks are stripped, so
+# the sentence starting a chunk is counted without its leading whitespace (" iota" is one token,
+# "iota" two) and the one ending it without its trailing whitespace.
+def iter_token_chunks(string, max_tokens=2000, model=gpt, overlap_tokens=0):
+    encoding = tokens.get_encoding(model)
+    window = deque()  # [sentence, token count, stripped token count or None] of the current chunk
+    window_tokens = 0  # Token count of the chunk, its first sentence counted once stripped
+    fresh = False  # Whether the window holds sentences not yielded yet
+
+    def count(text):
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def stripped_count(entry):
+        """Return the token count of a sentence without its leading whitespace, encoding it only when needed."""
+        if entry[2] is None:
+            entry[2] = count(entry[0].lstrip()) if entry[0][:1].isspace() else entry[1]
+        return entry[2]
+
+    def cut(sentence):
+        """Cut a sentence at token boundaries into pieces of at most max_tokens tokens once stripped."""
+        text = sentence.lstrip()
+        sentence_tokens = encoding.encode(text, disallowed_special=())
+        pieces = []
+        start = 0
+        while start < len(sentence_tokens):
+            size = max_tokens
+            piece = encoding.decode(sentence_tokens[start:start + size])
+            while size > 1 and count(piece.lstrip()) > max_tokens:  # Decoded text may encode differently
+                size -= 1
+                piece = encoding.decode(sentence_tokens[start:start + size])
+            if start == 0:
+                piece = sentence[:len(sentence) - len(text)] + piece
+            pieces.append([piece, count(piece), None])
+            start += size
+        return pieces
+
+    def chunk():
+        """Return the stripped chunk and its token count."""
+        text = ''.join(entry[0] for entry in window)
+        if not text[-1:].isspace():
+            return text.strip(), window_tokens
+        last = window[-1]  # Only the trailing whitespace of the last sentence is stripped
+        if len(window) == 1:
+            return text.strip(), count(last[0].strip())
+        return text.strip(), window_tokens - last[1] + count(last[0].rstrip())
+
+    for match in sentence_pattern.finditer(string):
+        sentence = match.group()
+        if not sentence.strip():  # Ignore empty sentences
+            continue
+        sentence_tokens = count(sentence)
+
+        # A sentence longer than max_tokens is cut at token boundaries
+        whole = sentence_tokens <= max_tokens
+        pending = deque([[sentence, sentence_tokens, None]] if whole else cut(sentence))
+        while pending:
+            entry = pending.popleft()
+            if window and window_tokens + entry[1] > max_tokens:
+                if fresh:
+                    text, chunk_tokens = chunk()
+                    if text:
+                        yield text, chunk_tokens
+                    fresh = False
+                # Keep the trailing sentences that fit in the overlap and leave room for this one
+                while window and (window_tokens > overlap_tokens or window_tokens + entry[1] > max_tokens):
+                    window_tokens -= stripped_count(window.popleft())
+                    if window:
+                        window_tokens += stripped_count(window[0]) - window[0][1]
+            if not window and whole and stripped_count(entry) > max_tokens:
+                # Starting a chunk, the sentence no longer fits once stripped
+                pending.extendleft(reversed(cut(entry[0])))
+                whole = False
+                continue
+            window.append(entry)
+            window_tokens += stripped_count(entry) if len(window) == 1 else entry[1]
+            fresh = True
+
+    if fresh:
+        text, chunk_tokens = chunk()
+        if text:
+            yield text, chunk_tokens
+
+# Generator yielding the chunks of iter_token_chunks without their token counts
+def iter_chunks(string, max_tokens=2000, model=gpt, overlap_tokens=0):
+    for chunk, _ in iter_token_chunks(string, max_tokens, model, overlap_tokens):
+        yield chunk
 
 # Function to split a string into subsections based on token limits, splitting by sentences
-def split_strings_from_subsection(subsection, max_tokens=2000, model=gpt):
+def split_strings_from_subsection(subsection, max_tokens=2000, model=gpt, overlap_tokens=0):
     titles, text = subsection
     string = "\n\n".join(titles + [text])
+    return list(iter_chunks(string, max_tokens, model, overlap_tokens))
 
-    # Split the string into sentences based on sentence-ending punctuation
-    sentences = re.split(r'([.!?])', string)
+# Function to group texts into requests of at most batch_size inputs and request_tokens tokens.
+# Returns a list of requests, each a list of text indices.
+def pack_requests(token_counts, batch_size=500, request_tokens=request_tokens):
+    requests = []
+    current = []
+    current_tokens = 0
+    for i, count in enumerate(token_counts):
+        if current and (len(current) >= batch_size or current_tokens + count > request_tokens):
+            requests.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += count
+    if current:
+        requests.append(current)
+    return requests
 
-    # Recombine sentences with their punctuation
-    sentences = [sentences[i] + (sentences[i+1] if i+1 < len(sentences) else '') for i in range(0, len(sentences), 2)]
+# Function to embed texts with requests packed by token count and up to max_workers in flight.
+# Returns the embeddings in text order (None where a request failed after its retries) and the errors.
+def embed_texts(texts, token_counts, embedding_model=em, batch_size=500, request_tokens=request_tokens, max_workers=1):
+    client = get_client()
 
-    chunks = []
-    current_chunk = ""
-    current_token_count = 0
+    def send(indices):
+        batch = [texts[i] for i in indices]
+        try:
+            response = throttle.call(client.embeddings.create, model=embedding_model, input=batch,
+                                     tokens=sum(token_counts[i] for i in indices), operation='embeddings')
+            return [e.embedding for e in response.data], None
+        except Exception as e:
+            return [None] * len(indices), e
 
-    for sentence in sentences:
-        if sentence.strip():  # Ignore empty sentences
-            # Calculate token count for the current chunk with the new sentence added
-            token_count = num_tokens(current_chunk + sentence, model)
+    requests = pack_requests(token_counts, batch_size, request_tokens)
+    embeddings = [None] * len(texts)
+    errors = []
+    for indices, (batch_embeddings, error) in zip(requests, map_ordered(send, requests, max_workers)):
+        for i, embedding in zip(indices, batch_embeddings):
+            embeddings[i] = embedding
+        if error is not None:
+            errors.append(error)
+    return embeddings, errors
 
-            if current_token_count + token_count <= max_tokens:
-                # If adding this sentence doesn't exceed the max token limit, add it to the chunk
-                current_chunk += sentence
-                current_token_count += token_count
-            else:
-                # If it exceeds the limit, save the current chunk and start a new one
-                chunks.append(current_chunk.strip())
-                current_chunk = sentence
-                current_token_count = token_count
+# Function to generate embeddings for processed sections
+def generate_embeddings(processed_sections, embedding_model=em, batch_size=500, max_workers=1):
+    token_counts = [num_tokens(section) for section in processed_sections] if throttle.tokens else [0] * len(processed_sections)
+    embeddings, errors = embed_texts(processed_sections, token_counts, embedding_model, batch_size,
+                                     max_workers=max_workers)
+    if errors:
+        raise errors[0]
+    return embeddings
 
-    # Add the last chunk if any
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+# Function to return the embeddings table written for a text file
+def embeddings_output_path(file_path, output_folder_path):
+    return f"{output_folder_path}/{file_path.split('/')[-1].replace('.txt', '.csv')}"
 
-    return chunks
+# Function to embed a single text file through the chunk cache and save its outputs.
+# Used where files are processed one at a time (e.g. the pipeline); returns the table path.
+def embed_file(file_path, output_folder_path, cache, gpt_model=gpt, em_model=em):
+    document = os.path.basename(file_path)
+    with telemetry.scope(stage='embed', document=document), telemetry.timer('pasqui_document_seconds'):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            cleaned_text = file.read()
+        with telemetry.timer('pasqui_step_seconds', step='chunk'):
+            chunks = list(iter_token_chunks("\n\n".join(["Section", cleaned_text]), model=gpt_model))
+        subsections = [chunk for chunk, _ in chunks]
 
-# Function to generate embeddings for processed sections
-def generate_embeddings(processed_sections, embedding_model=em, batch_size=500):
-    embeddings = []
-    for batch_start in range(0, len(processed_sections), batch_size):
-        batch_end = min(batch_start + batch_size, len(processed_sections))
-        batch = processed_sections[batch_start:batch_end]
-        response = client.embeddings.create(model=embedding_model, input=batch)
-        embeddings.extend([e.embedding for e in response.data])
-    return embeddings
+        keys = [make_key(em_model, chunk) for chunk in subsections]
+        cached = cache.get_many(keys)
+        missing = list(dict.fromkeys(chunk for chunk, key in zip(subsections, keys) if key not in cached))
+        telemetry.count('pasqui_cache_hits_total', len(keys) - len(missing), cache='embeddings')
+        telemetry.count('pasqui_cache_misses_total', len(missing), cache='embeddings')
+        if missing:
+            embeddings = generate_embeddings(missing, embedding_model=em_model)
+            new = {make_key(em_model, chunk): np.asarray(e, dtype=np.float32).tobytes()
+                   for chunk, e in zip(missing, embeddings)}
+            cache.set_many(new)
+            cached.update(new)
+
+        output_file_path = embeddings_output_path(file_path, output_folder_path)
+        save_embeddings(output_file_path, subsections, [np.frombuffer(cached[key], dtype=np.float32) for key in keys],
+                        [count for _, count in chunks])
+        return output_file_path
 
-# Function to process files, create folders if needed, and generate embeddings
-def pasqui_embedding(folder_path, output_folder_path, gpt_model=gpt, em_model=em):
-    try:
-        # Ensure the output folder exists
-        os.makedirs(output_folder_path, exist_ok=True)
+# Function to check whether a file's embeddings were already written by an earlier run
+def is_embedded(file_path, output_file_path):
+    if not (os.path.exists(output_file_path) and os.path.exists(matrix_path(output_file_path))):
+        return False
+    return os.path.getmtime(output_file_path) >= os.path.getmtime(file_path)
 
-        # Get the list of text files from the folder
-        text_files = [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.endswith(('.txt', '.docx'))]
+# Function to process files, create folders if needed, and generate embeddings.
+# Chunk vectors are cached in a SQLite file keyed by (embedding model, chunk text), so unchanged
+# chunks are never re-embedded; files whose outputs are newer than their source are skipped.
+# Uncached chunks from many files are packed into requests of up to request_tokens tokens and
+# batch_size inputs, with up to max_workers requests in flight within the per-minute budgets.
+# With deduplicate, texts are fingerprinted (see dedup.py) and a file duplicating an earlier one
+# gets a copy of that file's embeddings; with chunk_dedup_threshold, a new chunk that nearly
+# duplicates an embedded one reuses its vector in that file's output (the cache only ever holds exact
+# vectors). The signature index persists in the output folder.
+# With work_queue (a SQLite file, see workqueue.py) several processes or machines can embed the same
+# folder: each claims files from the queue in rounds and commits those whose embeddings it saved.
+# Tasks are kept per output folder and models; with overwrite the files already done are redone once
+# per run: pass the workers the same run_id, or a worker started after the others finished begins a
+# new run (see LeaseQueue.enqueue).
+def pasqui_embedding(folder_path, output_folder_path, gpt_model=gpt, em_model=em, cache_path=None, overwrite=False,
+                     batch_size=500, request_tokens=request_tokens, max_workers=1,
+                     requests_per_minute=None, tokens_per_minute=None, deduplicate=False,
+                     dedup_threshold=dedup.threshold, chunk_dedup_threshold=None, signatures_path=None,
+                     work_queue=None, lease_seconds=300, claim_size=None, run_id=None):
+    global throttle
+    throttle = RequestThrottle(max_in_flight=max_workers, requests_per_minute=requests_per_minute,
+                               tokens_per_minute=tokens_per_minute)
 
-        # Process each file in the folder
-        for file_path in text_files:
+    # Ensure the output folder exists
+    os.makedirs(output_folder_path, exist_ok=True)
+    cache = DiskCache(cache_path or os.path.join(output_folder_path, cache_name), max_entries=None)
+
+    # Get the list of text files from the folder
+    text_files = [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.endswith(('.txt', '.docx'))]
+
+    stats = {'embedded': 0, 'skipped': 0, 'failed': 0, 'api_calls': 0, 'tokens_embedded': 0, 'tokens_saved': 0,
+             'duplicates': 0, 'near_duplicate_chunks': 0, 'api_calls_avoided': 0, 'tokens_avoided': 0}
+
+    # Signature indexes of whole texts and of chunks, sharing one SQLite file
+    documents = chunk_index = None
+    if deduplicate or chunk_dedup_threshold:
+        signatures_path = signatures_path or os.path.join(output_folder_path, dedup.signatures_name)
+    if deduplicate:
+        documents = dedup.SignatureIndex(signatures_path, threshold=dedup_threshold)
+    if chunk_dedup_threshold:
+        chunk_index = dedup.SignatureIndex(signatures_path, kind='chunk', threshold=chunk_dedup_threshold)
+    avoided = []  # Token counts of the chunks never sent thanks to deduplication
+    done_files = set()  # Files whose embeddings are saved (or were already)
+
+    def reuse(file_path, output_file_path, canonical_output, value):
+        """Give a duplicate file a copy of its canonical file's embeddings."""
+        try:
+            copy_embeddings(canonical_output, output_file_path)
+            counts = load_token_counts(output_file_path) or []
+        except Exception as e:
+            logging.error(f"Error reusing {canonical_output} for {file_path}: {e}")
+            return False
+        avoided.extend(counts)
+        stats['duplicates'] += 1
+        stats['embedded'] += 1
+        done_files.add(file_path)
+        telemetry.count('pasqui_duplicates_total', stage='embed', kind='document')
+        telemetry.count('pasqui_documents_total', stage='embed', status='duplicate')
+        logging.info(f"{file_path} duplicates {canonical_output} (similarity {value:.2f}), embeddings reused")
+        return True
+
+    # Files waiting for their uncached chunks, and those chunks (key -> (chunk, tokens)).
+    # They are flushed once enough tokens are pending to keep every worker busy.
+    waiting = []
+    pending = {}
+    pending_tokens = 0
+    window_tokens = max(max_workers or 1, 1) * request_tokens
+
+    def save(file_path, output_file_path, chunks, vectors):
+        try:
+            # Save texts and token counts to CSV and embeddings to a binary .npy matrix next to it
+            # (each replaced atomically); the counts let prompts be packed without re-tokenising
+            save_embeddings(output_file_path, [chunk for chunk, _ in chunks], vectors, [count for _, count in chunks])
+            stats['embedded'] += 1
+            done_files.add(file_path)
+            telemetry.count('pasqui_documents_total', stage='embed', status='done')
+            logging.info(f"Saved embeddings to {output_file_path}")
+        except Exception as e:
+            stats['failed'] += 1
+            telemetry.count('pasqui_documents_total', stage='embed', status='failed')
+            logging.error(f"Error processing {file_path}: {e}")
+
+    def flush():
+        nonlocal pending_tokens
+        keys = list(pending)
+        texts = [pending[key][0] for key in keys]
+        counts = [pending[key][1] for key in keys]
+        with telemetry.scope(stage='embed'):
+            embeddings, errors = embed_texts(texts, counts, em_model, batch_size, request_tokens, max_workers)
+        stats['api_calls'] += len(pack_requests(counts, batch_size, request_tokens))
+        for error in errors:
+            logging.error(f"Error embedding chunks: {error}")
+
+        new = {key: np.asarray(e, dtype=np.float32).tobytes() for key, e in zip(keys, embeddings) if e is not None}
+        cache.set_many(new)
+        stats['tokens_embedded'] += sum(count for key, count in zip(keys, counts) if key in new)
+
+        # Route the vectors back to the files they came from
+        for file_path, output_file_path, chunks, file_keys, cached in waiting:
+            if all(key in cached or key in new for key in file_keys):
+                vectors = [np.frombuffer(cached.get(key) or new[key], dtype=np.float32) for key in file_keys]
+                save(file_path, output_file_path, chunks, vectors)
+            else:
+                stats['failed'] += 1
+                telemetry.count('pasqui_documents_total', stage='embed', status='failed')
+                logging.error(f"Error processing {file_path}: some chunks could not be embedded")
+        waiting.clear()
+        pending.clear()
+        pending_tokens = 0
+
+    def files_to_embed():
+        """Yield every text file, or with a work queue the files this process claims, round by round."""
+        if not work_queue:
+            yield from text_files
+            return
+        queue = LeaseQueue(work_queue, lease_seconds=lease_seconds)
+        items = [(os.path.basename(path), file_version(path)) for path in text_files]
+        try:
+            stage = stage_key('embed', os.path.abspath(output_folder_path), gpt_model, em_model)
+            for leases in queue.batches(stage, items, claim_size or max(max_workers or 1, 1) * 8, redo=overwrite,
+                                         run=run_id):
+                claimed = [os.path.join(folder_path, lease.name) for lease in leases]
+                yield from claimed
+                if waiting:
+                    flush()
+                for lease, file_path in zip(leases, claimed):
+                    if file_path in done_files:
+                        queue.complete(lease, embeddings_output_path(file_path, output_folder_path))
+                    else:
+                        queue.fail(lease, f"Could not embed {file_path}")
+        finally:
+            queue.close()
+
+    # Process each file in the folder; one failure does not stop the others
+    for file_path in files_to_embed():
+        output_file_path = embeddings_output_path(file_path, output_folder_path)
+        name = dedup.document_name(output_file_path)
+        if not overwrite and is_embedded(file_path, output_file_path):
+            done_files.add(file_path)
+            if documents is not None and documents.version(name) != dedup.file_version(file_path):
+                try:  # Fingerprinted so later duplicates can match it
+                    with open(file_path, 'r', encoding='utf-8') as file:
+                        documents.add(name, file.read(), version=dedup.file_version(file_path))
+                except Exception as e:
+                    logging.error(f"Error fingerprinting {file_path}: {e}")
+            stats['skipped'] += 1
+            telemetry.count('pasqui_documents_total', stage='embed', status='unchanged')
+            continue
+
+        document = os.path.basename(file_path)
+        try:
             # Load text from file
             with open(file_path, 'r', encoding='utf-8') as file:
                 cleaned_text = file.read()
 
+            if documents is not None:
+                canonical, value = documents.add(name, cleaned_text, version=dedup.file_version(file_path))
+                if canonical is not None:
+                    canonical_output = os.path.join(output_folder_path, canonical + '.csv')
+                    if any(entry[1] == canonical_output for entry in waiting):
+                        flush()  # The canonical file's chunks are still pending
+                    if os.path.exists(canonical_output) and os.path.exists(matrix_path(canonical_output)) and \
+                            reuse(file_path, output_file_path, canonical_output, value):
+                        continue
+
             # Split the text into subsections based on token limits
-            subsections = split_strings_from_subsection((["Section"], cleaned_text), model=gpt)
+            with telemetry.timer('pasqui_step_seconds', stage='embed', document=document, step='chunk'):
+                chunks = list(iter_token_chunks("\n\n".join(["Section", cleaned_text]), model=gpt_model))
+        except Exception as e:
+            stats['failed'] += 1
+            telemetry.count('pasqui_documents_total', stage='embed', status='failed')
+            logging.error(f"Error processing {file_path}: {e}")
+            continue
+
+        file_keys = [make_key(em_model, chunk) for chunk, _ in chunks]
+        cached = cache.get_many(file_keys)
+        stats['tokens_saved'] += sum(count for key, (_, count) in zip(file_keys, chunks) if key in cached)
+        if chunk_index is not None:
+            # A new chunk nearly identical to an embedded one (e.g. boilerplate) borrows its vector for this file;
+            # the link stays in the chunk index, never in the cache. Keys hash the text, so they double as version.
+            for key, (chunk, count) in zip(file_keys, chunks):
+                if key in cached or key in pending:
+                    continue
+                canonical_key, _ = chunk_index.add(key, chunk, version=key)
+                vector = cache.get(canonical_key) if canonical_key else None
+                if vector is not None:
+                    cached[key] = vector
+                    avoided.append(count)
+                    stats['near_duplicate_chunks'] += 1
+                    telemetry.count('pasqui_duplicates_total', stage='embed', document=document, kind='chunk')
+        if telemetry.enabled:
+            hits = sum(key in cached for key in file_keys)
+            telemetry.count('pasqui_cache_hits_total', hits, stage='embed', document=document, cache='embeddings')
+            telemetry.count('pasqui_cache_misses_total', len(file_keys) - hits, stage='embed', document=document,
+                            cache='embeddings')
+            telemetry.count('pasqui_chunk_tokens_total', sum(count for _, count in chunks), stage='embed',
+                            document=document)
+
+        if len(cached) == len(set(file_keys)):
+            # Every chunk is cached: no API call needed
+            save(file_path, output_file_path, chunks,
+                 [np.frombuffer(cached[key], dtype=np.float32) for key in file_keys])
+            continue
 
-            # Generate embeddings
-            embeddings = generate_embeddings(subsections, embedding_model=em_model)
+        for key, (chunk, count) in zip(file_keys, chunks):
+            if key not in cached:
+                if key in pending:
+                    stats['tokens_saved'] += count  # Same chunk already pending for another file
+                else:
+                    pending[key] = (chunk, count)
+                    pending_tokens += count
+        waiting.append((file_path, output_file_path, chunks, file_keys, cached))
+        if pending_tokens >= window_tokens:
+            flush()
 
-            # Save embeddings to CSV
-            df = pd.DataFrame({"text": subsections, "embedding": embeddings})
-            output_file_path = f"{output_folder_path}/{file_path.split('/')[-1].replace('.txt', '.csv')}"
-            df.to_csv(output_file_path, index=False)
-            print(f"Saved embeddings to {output_file_path}")
+    if waiting:
+        flush()
 
-    except Exception as e:
-        print(f"Error processing files in {folder_path}: {e}")
\ No newline at end of file
+    cache.close()
+    print(f"Embedded {stats['embedded']} files ({stats['skipped']} already done, {stats['failed']} failed): "
+          f"{stats['api_calls']} API calls, {stats['tokens_embedded']} tokens embedded, "
+          f"{stats['tokens_saved']} tokens served from cache")
+    for index in (documents, chunk_index):
+        if index is not None:
+            index.close()
+    if documents is not None or chunk_index is not None:
+        # Calls are counted as if the avoided chunks had been packed into requests of their own
+        stats['api_calls_avoided'] = len(pack_requests(avoided, batch_size, request_tokens))
+        stats['tokens_avoided'] = sum(avoided)
+        telemetry.count('pasqui_dedup_avoided_calls_total', stats['api_calls_avoided'], stage='embed')
+        telemetry.count('pasqui_dedup_avoided_tokens_total', stats['tokens_avoided'], stage='embed')
+        print(f"Deduplication: {stats['duplicates']} duplicate files and {stats['near_duplicate_chunks']} near-duplicate "
+              f"chunks reused, about {stats['api_calls_avoided']} API calls and {stats['tokens_avoided']} tokens avoided")
+    return stats
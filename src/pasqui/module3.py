@@ -1,12 +1,14 @@
 import os
-import ast
+import json
 import logging
-import pandas as pd
 import numpy as np
-import tiktoken
-import openai
-from scipy import spatial  # For calculating vector similarities
-from openai import Client
+from itertools import zip_longest
+from . import store, tokens, telemetry, dedup
+from .clients import get_client
+from .index import CorpusIndex
+from .cache import DiskCache, make_key
+from .ratelimit import RequestThrottle, map_ordered
+from .workqueue import LeaseQueue, temporary_path, file_version, stage_key
 
 # Constants
 num = 20
@@ -15,84 +17,477 @@ token_budget = 7000 - 500
 em = "text-embedding-3-small"
 intro = None
 
-def get_client():
-    """Initialize OpenAI client. API key must be set before calling this function."""
-    api_key = os.getenv("api_key")  # Get API key from environment
-    if not api_key:
-        raise ValueError("API key is required but not set. Use os.environ['api_key'] = 'your-key' before calling OpenAI functions.")
-    
-    return openai.Client(api_key=api_key)  # Initialize client only when needed
+default_system_message = """
+You are Professor Smith, a highly rigorous social sciences professor.
+Use only the information of the text I provided to answer the question.
+If you don't know the answer, just say that you do not know and return NA.
+"""
+
+# Appended, with the numbered questions, to the segments of a packed request (see ask_many)
+packed_instructions = ("\n\nAnswer each of the numbered questions below using only the segments above. "
+                       "Reply with a JSON object mapping every question number to its answer, "
+                       'e.g. {"1": "...", "2": "..."}, and use "NA" when the segments do not answer a question.\n')
+
+# Query embeddings shared by every file of a run, keyed by (embedding model, query text)
+query_cache = DiskCache(max_entries=10000)
+query_cache_name = ".pasqui_queries.sqlite"  # Default file of pasqui_summarising, kept in embeddings_dir
+
+# Chat answers keyed by the full request (model, temperature, system and user messages), so
+# re-asking an identical prompt costs nothing; None disables it (see use_response_cache)
+response_cache = DiskCache(max_entries=10000)
+response_cache_name = ".pasqui_responses.sqlite"  # Default file of pasqui_summarising, kept in embeddings_dir
+
+# Limits shared by every API request of a run (in-flight count, per-minute budgets, retries)
+throttle = RequestThrottle()
+
+def configure_requests(max_in_flight=None, requests_per_minute=None, tokens_per_minute=None, max_retries=5):
+    """Set the concurrency and rate limits used for every API request."""
+    global throttle
+    throttle = RequestThrottle(max_in_flight=max_in_flight, requests_per_minute=requests_per_minute,
+                               tokens_per_minute=tokens_per_minute, max_retries=max_retries)
+    return throttle
 
 def load_embeddings(file_path):
-    """Load embeddings from a CSV file."""
-    df = pd.read_csv(file_path)
-    df['embedding'] = df['embedding'].apply(ast.literal_eval).apply(np.array)
-    return df
+    """Load embeddings from a CSV file, memory-mapping the .npy matrix written next to it."""
+    return store.load_embeddings(file_path)
+
+def use_query_cache(path=None, max_entries=10000):
+    """Replace the query-embedding cache, persisting it to a SQLite file when a path is given."""
+    global query_cache
+    query_cache = DiskCache(path, max_entries=max_entries)
+    return query_cache
+
+def use_response_cache(path=None, max_entries=100000, ttl=None, enabled=True):
+    """Replace the chat-response cache, persisting it to a SQLite file when a path is given.
+
+    Entries older than ttl seconds are ignored and dropped; enabled=False turns caching off.
+    """
+    global response_cache
+    response_cache = DiskCache(path, max_entries=max_entries, ttl=ttl) if enabled else None
+    return response_cache
+
+def embed_queries(queries, model=em):
+    """Embed a list of queries and return them as a float32 matrix.
+
+    Cached queries are served from query_cache, the rest are embedded in a single request.
+    """
+    if not queries:
+        return np.empty((0, 0), dtype=np.float32)
+    keys = [make_key(model, query) for query in queries]
+    cached = query_cache.get_many(keys)
+
+    missing = list(dict.fromkeys(q for q, k in zip(queries, keys) if k not in cached))
+    telemetry.count('pasqui_cache_hits_total', len(queries) - len(missing), cache='queries')
+    telemetry.count('pasqui_cache_misses_total', len(missing), cache='queries')
+    if missing:
+        client = get_client()  # Shared client, created on first use
+        tokens = sum(num_tokens(query) for query in missing) if throttle.tokens else 0
+        response = throttle.call(client.embeddings.create, model=model, input=missing, tokens=tokens,
+                                 operation='query_embeddings')
+        new = {
+            make_key(model, query): np.asarray(e.embedding, dtype=np.float32).tobytes()
+            for query, e in zip(missing, response.data)
+        }
+        query_cache.set_many(new)
+        cached.update(new)
+
+    return np.array([np.frombuffer(cached[k], dtype=np.float32) for k in keys])
+
+def embedding_matrix(df):
+    """Return the embeddings of a DataFrame as one contiguous float32 matrix, built once per DataFrame."""
+    cached = store.frame_data(df)
+    matrix = cached.get('embedding_matrix')
+    if matrix is None or len(matrix) != len(df):
+        if len(df) == 0:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        else:
+            matrix = np.vstack(df['embedding'].to_numpy()).astype(np.float32)
+        cached['embedding_matrix'] = matrix
+    return matrix
+
+def embedding_norms(df):
+    """Return the norm of every embedding, computed once per DataFrame."""
+    cached = store.frame_data(df)
+    norms = cached.get('embedding_norms')
+    if norms is None or len(norms) != len(df):
+        norms = np.linalg.norm(embedding_matrix(df), axis=1)
+        norms[norms == 0] = 1
+        cached['embedding_norms'] = norms
+    return norms
+
+def top_k_indices(scores, k):
+    """Return the indices of the k highest scores, best first (ties keep document order)."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        indices = np.sort(np.argpartition(-scores, k - 1)[:k])
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind='stable')]
+
+def mmr_indices(scores, candidates, vectors, k, diversity):
+    """Pick k of the candidate indices by maximal marginal relevance.
+
+    Each pick maximises (1 - diversity) * relatedness - diversity * (highest similarity to a chunk
+    already picked); vectors holds the unit-norm embedding of every candidate.
+    """
+    similarity = vectors @ vectors.T
+    picked = []
+    redundancy = np.full(len(candidates), -np.inf)
+    available = np.ones(len(candidates), dtype=bool)
+    for _ in range(min(k, len(candidates))):
+        value = (1 - diversity) * scores[candidates] - diversity * (redundancy if picked else 0)
+        value[~available] = -np.inf
+        best = int(np.argmax(value))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return candidates[picked]
+
+def rank_by_relatedness(query_embeddings, df, top_n=num, diversity=None):
+    """Return, for every query embedding, a list of (string, relatedness) sorted by relatedness.
+
+    With diversity (between 0 and 1) the top_n are instead picked from the 4 * top_n most related
+    chunks by maximal marginal relevance, so near-duplicate chunks do not fill the prompt.
+    """
+    with telemetry.timer('pasqui_step_seconds', step='retrieve'):
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if len(df) == 0:
+            return [[] for _ in query_embeddings]
+
+        # Cosine similarity of every query against every chunk in one matrix product
+        query_norms = np.linalg.norm(query_embeddings, axis=1)
+        query_norms[query_norms == 0] = 1
+        scores = (query_embeddings @ embedding_matrix(df).T) / np.outer(query_norms, embedding_norms(df))
+
+        texts = df['text'].to_numpy()
+        rankings = []
+        for row in scores:
+            if diversity:
+                candidates = top_k_indices(row, 4 * top_n)
+                vectors = embedding_matrix(df)[candidates] / embedding_norms(df)[candidates, None]
+                indices = mmr_indices(row, candidates, vectors, top_n, diversity)
+            else:
+                indices = top_k_indices(row, top_n)
+            rankings.append([(texts[i], float(row[i])) for i in indices])
+        return rankings
 
 def strings_ranked_by_relatedness(query, df, top_n=num):
     """Return a list of strings sorted by relatedness."""
-    client = get_client()  # Initialize only when needed
-
-    query_embedding_response = client.embeddings.create(
-        model=em,
-        input=query,
-    )
-    query_embedding = query_embedding_response.data[0].embedding
-    strings_and_relatednesses = [
-        (row["text"], 1 - spatial.distance.cosine(query_embedding, row["embedding"]))
-        for _, row in df.iterrows()
-    ]
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-    return strings_and_relatednesses[:top_n]
+    query_embedding = embed_queries([query])
+    return rank_by_relatedness(query_embedding, df, top_n=top_n)[0]
 
 def num_tokens(text, model=gpt):
     """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
-
-def query_message(query, df, model, token_budget, question, introduction):
+    return tokens.num_tokens(text, model)
+
+def chunk_token_counts(texts, df=None, model=gpt):
+    """Return the token count of every chunk text.
+
+    Counts come from the n_tokens column written at embedding time when the DataFrame has one;
+    other texts are counted once and remembered on the DataFrame.
+    """
+    counts = None if df is None else store.frame_data(df).get('token_counts')
+    if df is not None and (counts is None or counts[0] != (model, len(df))):
+        stored = dict(zip(df['text'], df['n_tokens'])) if 'n_tokens' in df.columns else {}
+        counts = ((model, len(df)), stored)
+        store.frame_data(df)['token_counts'] = counts
+    known = counts[1] if counts else {}
+    result = []
+    for text in texts:
+        count = known.get(text)
+        if count is None:
+            count = num_tokens(text, model=model)
+            if df is not None:
+                known[text] = count
+        result.append(int(count))
+    return result
+
+def overlap_length(a, b, min_overlap=32):
+    """Return the length of the longest suffix of a that is also a prefix of b (0 below min_overlap chars)."""
+    if len(a) < min_overlap or len(b) < min_overlap:
+        return 0
+    best = 0
+    start = a.find(b[:min_overlap])
+    while start != -1:
+        if b.startswith(a[start:]):
+            best = len(a) - start
+            break  # Earlier starts give longer overlaps
+        start = a.find(b[:min_overlap], start + 1)
+    return best
+
+def dedupe_segments(texts):
+    """Drop texts contained in an earlier one and trim the parts overlapping earlier texts.
+
+    Returns (kept text, whether it was trimmed) pairs in the original order.
+    """
+    kept = []
+    for text in texts:
+        if any(text in other for other, _ in kept):
+            continue
+        head = max((overlap_length(other, text) for other, _ in kept), default=0)
+        tail = max((overlap_length(text, other) for other, _ in kept), default=0)
+        trimmed = text[head:len(text) - tail].strip() if head + tail < len(text) else ''
+        if trimmed:
+            kept.append((trimmed, bool(head or tail)))
+    return kept
+
+def pack_context(texts, token_counts, token_budget, question, introduction=None, model=gpt, dedupe=False):
+    """Return the introduction, then as many segments as fit in token_budget, then the question.
+
+    Segments are taken in order until the first one that does not fit, as query_message always did.
+    The cut is found by adding the per-chunk token counts and then confirmed by encoding the
+    message on either side of it, so only a couple of full encodings are needed per prompt and
+    the result is exactly the one of encoding the growing message after every segment.
+    With dedupe, segments contained in or overlapping earlier ones are dropped or trimmed first.
+    """
+    introduction = introduction or ""
+    if dedupe:
+        segments = dedupe_segments(texts)
+        counts = dict(zip(texts, token_counts))
+        token_counts = [num_tokens(text, model=model) if trimmed else counts[text] for text, trimmed in segments]
+        texts = [text for text, _ in segments]
+    pieces = [f'\n\nSegment:\n{text}' for text in texts]
+
+    def message(k):
+        return introduction + ''.join(pieces[:k]) + question
+
+    exact = {}
+    def fits(k):
+        if k not in exact:
+            exact[k] = num_tokens(message(k), model=model) <= token_budget
+        return exact[k]
+
+    # Estimate the cut from the stored counts, then move it until it is exact
+    overhead = num_tokens('\n\nSegment:\n', model=model)
+    total = num_tokens(introduction + question, model=model)
+    k = 0
+    while k < len(pieces) and total + token_counts[k] + overhead <= token_budget:
+        total += token_counts[k] + overhead
+        k += 1
+    while k > 0 and not fits(k):
+        k -= 1
+    while k < len(pieces) and fits(k + 1):
+        k += 1
+    return message(k)
+
+def query_message(query, df, model, token_budget, question, introduction, strings=None, dedupe=False):
     """Return a message for GPT with relevant source texts."""
-    strings = strings_ranked_by_relatedness(query, df)
-    message = introduction or ""
-    
-    for string in strings:
-        next_article = f'\n\nSegment:\n{string[0]}'
-        if num_tokens(message + next_article + question, model=model) > token_budget:
-            break
-        else:
-            message += next_article
-    return message + question
+    if strings is None:
+        strings = strings_ranked_by_relatedness(query, df)
+    texts = [string[0] for string in strings]
+    with telemetry.timer('pasqui_step_seconds', step='pack'):
+        return pack_context(texts, chunk_token_counts(texts, df, model=model), token_budget, question,
+                            introduction, model=model, dedupe=dedupe)
 
-def ask(query, df, model=gpt, token_budget=token_budget, introduction=intro, system_message=None):
-    """Use only the provided information to answer the query, if you don't know the answer return NA"""
-    client = get_client()  # Initialize client inside function
+def chat(system_message, user_message, model=gpt, response_format=None, valid=None):
+    """Send one chat request at temperature 0 and return the reply.
 
-    if system_message is None:
-        system_message = """
-You are Professor Smith, a highly rigorous social sciences professor.
-Use only the information of the text I provided to answer the question.
-If you don't know the answer, just say that you do not know and return NA.
-"""
-
-    user_message = query_message(query, df, model=model, token_budget=token_budget, question=query, introduction=introduction)
+    Replies are served from and stored in response_cache; a reply for which valid(reply) is false
+    is returned but not stored, so the request is sent again next time.
+    """
+    client = get_client()  # Shared client, created on first use
 
     messages = [
         {"role": "system", "content": system_message},
         {"role": "user", "content": user_message},
     ]
+    options = {'response_format': response_format} if response_format else {}
+
+    # Answers are deterministic enough at temperature 0 to be reused for an identical request
+    cache = response_cache
+    key = make_key('chat', model, 0, system_message, user_message, *options.values())
+    if cache is not None:
+        answer = cache.get(key)
+        if answer is not None:
+            telemetry.count('pasqui_cache_hits_total', cache='responses')
+            return answer
+        telemetry.count('pasqui_cache_misses_total', cache='responses')
+
+    tokens = num_tokens(system_message + user_message, model=model) if throttle.tokens else 0
+    response = throttle.call(client.chat.completions.create, model=model, messages=messages, temperature=0,
+                             tokens=tokens, operation='chat', **options)
+    answer = response.choices[0].message.content
+    if cache is not None and answer is not None and (valid is None or valid(answer)):
+        cache.set(key, answer)
+    return answer
+
+def ask(query, df, model=gpt, token_budget=token_budget, introduction=intro, system_message=None, strings=None,
+        dedupe=False):
+    """Use only the provided information to answer the query, if you don't know the answer return NA"""
+    if system_message is None:
+        system_message = default_system_message
+
+    user_message = query_message(query, df, model=model, token_budget=token_budget, question=query, introduction=introduction, strings=strings, dedupe=dedupe)
+    return chat(system_message, user_message, model=model)
+
+def interleave_rankings(rankings):
+    """Return the texts of several rankings, every first-ranked text, then every second, and so on, without repeats."""
+    texts = []
+    seen = set()
+    for row in zip_longest(*rankings):
+        for item in row:
+            if item is not None and item[0] not in seen:
+                seen.add(item[0])
+                texts.append(item[0])
+    return texts
+
+def packed_question_block(questions):
+    """Return the instructions and numbered questions that close a packed prompt."""
+    return packed_instructions + ''.join(f"\n{n}. {question}" for n, question in enumerate(questions, 1))
+
+def group_questions(questions, rankings, df=None, model=gpt, token_budget=token_budget, introduction=intro,
+                    max_questions=10, question_segments=3):
+    """Group the questions whose retrieved context overlaps, for asking each group in one request.
+
+    Each question needs its question_segments best segments; it joins the group sharing most of
+    them, as long as the union of the group's segments and questions still fits in token_budget
+    and the group has fewer than max_questions. Returns lists of question indices.
+    """
+    cores = [list(dict.fromkeys(text for text, _ in ranking[:question_segments])) for ranking in rankings]
+    texts = list(dict.fromkeys(text for core in cores for text in core))
+    overhead = num_tokens('\n\nSegment:\n', model=model)
+    segment_tokens = {text: count + overhead for text, count in zip(texts, chunk_token_counts(texts, df, model=model))}
+    budget = token_budget - num_tokens((introduction or "") + packed_instructions, model=model)
+
+    groups = []  # [question indices, segments, estimated tokens]
+    for i, core in enumerate(cores):
+        question_tokens = num_tokens(f"\n{len(questions)}. {questions[i]}", model=model)
+        best, best_shared, best_new = None, 0, None
+        for group in groups:
+            members, segments, used = group
+            if len(members) >= max_questions:
+                continue
+            new = [text for text in core if text not in segments]
+            shared = len(core) - len(new)
+            if shared > best_shared and used + sum(segment_tokens[t] for t in new) + question_tokens <= budget:
+                best, best_shared, best_new = group, shared, new
+        if best is None:
+            groups.append([[i], set(core), sum(segment_tokens[t] for t in core) + question_tokens])
+        else:
+            best[0].append(i)
+            best[1].update(best_new)
+            best[2] += sum(segment_tokens[t] for t in best_new) + question_tokens
+    return [members for members, _, _ in groups]
 
-    response = client.chat.completions.create(model=model, messages=messages, temperature=0)
-    return response.choices[0].message.content
+def parse_packed_answers(reply, count):
+    """Return the answers of a packed reply in question order, None for each question it misses.
 
-# ask_questions_for_file remains the same, as the customizable parts are already defined outside.
-def pasqui_asks(file_path, questions):
-    df = load_embeddings(file_path)
-    answers = {}
-    for question in questions:
-        answer = ask(question, df)
-        answers[question] = answer
+    Returns None when the reply holds no JSON object.
+    """
+    if not reply:
+        return None
+    start, end = reply.find('{'), reply.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(reply[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    answers = []
+    for n in range(1, count + 1):
+        answer = data.get(str(n))
+        if answer is None or answer == '':
+            answers.append(None)
+        else:
+            answers.append(answer.strip() if isinstance(answer, str) else json.dumps(answer))
     return answers
 
+def ask_many(questions, df, rankings, model=gpt, token_budget=token_budget, introduction=intro, system_message=None,
+             dedupe=False):
+    """Answer several questions in one request, from the union of their ranked segments.
+
+    Segments are taken best rank first across the questions until token_budget is reached, and the
+    model is asked for a JSON object keyed by question number. Returns the answers in question
+    order, with None for every question the reply does not answer.
+    """
+    if system_message is None:
+        system_message = default_system_message
+    texts = interleave_rankings(rankings)
+    with telemetry.timer('pasqui_step_seconds', step='pack'):
+        user_message = pack_context(texts, chunk_token_counts(texts, df, model=model), token_budget,
+                                    packed_question_block(questions), introduction, model=model, dedupe=dedupe)
+
+    def complete(reply):
+        answers = parse_packed_answers(reply, len(questions))
+        return answers is not None and None not in answers
+
+    reply = chat(system_message, user_message, model=model, response_format={"type": "json_object"}, valid=complete)
+    return parse_packed_answers(reply, len(questions)) or [None] * len(questions)
+
+# ask_questions_for_file remains the same, as the customizable parts are already defined outside.
+# dedupe and diversity opt into smarter prompt packing (see pack_context and rank_by_relatedness).
+# packed asks questions with overlapping context together (see group_questions and ask_many); with
+# fallback, questions a packed reply does not answer are asked one by one, otherwise they are left out.
+def pasqui_asks(file_path, questions, max_workers=None, dedupe=False, diversity=None, packed=False,
+                max_questions_per_request=10, question_segments=3, fallback=True):
+    with telemetry.scope(stage='summarise', document=os.path.basename(file_path)), \
+            telemetry.timer('pasqui_document_seconds'):
+        with telemetry.timer('pasqui_step_seconds', step='load'):
+            df = load_embeddings(file_path)
+        # Rank the document for every question at once instead of one pass per question
+        rankings = rank_by_relatedness(embed_queries(questions), df, diversity=diversity) if questions else []
+
+        # Questions are asked concurrently up to the in-flight limit set with configure_requests
+        if max_workers is None:
+            max_workers = throttle.max_in_flight or 1
+        if not packed:
+            replies = map_ordered(lambda item: ask(item[0], df, strings=item[1], dedupe=dedupe),
+                                  zip(questions, rankings), max_workers)
+        else:
+            groups = group_questions(questions, rankings, df, max_questions=max_questions_per_request,
+                                     question_segments=question_segments)
+
+            def answer_group(group):
+                if len(group) == 1:
+                    return [ask(questions[group[0]], df, strings=rankings[group[0]], dedupe=dedupe)]
+                telemetry.count('pasqui_packed_questions_total', len(group))
+                group_replies = ask_many([questions[i] for i in group], df, [rankings[i] for i in group],
+                                         dedupe=dedupe)
+                missing = [n for n, reply in enumerate(group_replies) if reply is None]
+                if missing:
+                    logging.warning(f"Packed reply for {os.path.basename(file_path)} left {len(missing)} of "
+                                    f"{len(group)} questions unanswered")
+                    telemetry.count('pasqui_packed_unanswered_total', len(missing))
+                if fallback:
+                    for n in missing:
+                        i = group[n]
+                        group_replies[n] = ask(questions[i], df, strings=rankings[i], dedupe=dedupe)
+                return group_replies
+
+            replies = [None] * len(questions)
+            for group, group_replies in zip(groups, map_ordered(answer_group, groups, max_workers)):
+                for i, reply in zip(group, group_replies):
+                    replies[i] = reply
+
+        answers = {}
+        for question, answer in zip(questions, replies):
+            if packed and answer is None:
+                continue  # Left unanswered by a packed reply; written as "No answer found"
+            answers[question] = answer
+        return answers
+
+def pasqui_corpus_asks(index_dir, questions, documents=None, top_n=num, nprobe=8, max_workers=None):
+    """Answer questions from the most related chunks of the whole corpus index built by pasqui_indexing.
+
+    documents optionally restricts retrieval to those embedding file names.
+    """
+    with telemetry.scope(stage='corpus_asks'):
+        corpus = CorpusIndex(index_dir)
+        try:
+            hits = corpus.search(embed_queries(questions), k=top_n, documents=documents, nprobe=nprobe) if questions else []
+        finally:
+            corpus.close()
+        rankings = [[(text, relatedness) for _, text, relatedness in question_hits] for question_hits in hits]
+
+        if max_workers is None:
+            max_workers = throttle.max_in_flight or 1
+        replies = map_ordered(lambda item: ask(item[0], None, strings=item[1]), zip(questions, rankings), max_workers)
+        return dict(zip(questions, replies))
+
 def setup_logging(log_file_path):
     """Ensure the log directory exists and set up logging."""
     log_dir = os.path.dirname(log_file_path)
@@ -115,9 +510,11 @@ def process_file(file_path, questions, headings, pasqui_asks):
     try:
         answers = pasqui_asks(file_path, questions)  # Get answers
         logging.info(f"Successfully processed {file_path}")
+        telemetry.count('pasqui_documents_total', stage='summarise', status='done')
         return answers  # Ensure it returns answers
     except Exception as e:
         logging.error(f"Error processing {file_path}: {e}")
+        telemetry.count('pasqui_documents_total', stage='summarise', status='failed')
         return None
 
 # Function to write answers to a text file
@@ -126,20 +523,30 @@ def write_answers_to_file(file_path, answers, questions, headings, summaries_out
         # Generate text output file path
         text_output_path = os.path.join(summaries_out, f"{file_path}.txt")
 
-        # Open the text file for writing
-        with open(text_output_path, 'w') as textfile:
+        # Open a temporary file for writing, then replace the summary atomically
+        tmp_path = temporary_path(text_output_path)
+        with open(tmp_path, 'w') as textfile:
             textfile.write(f"Results for {file_path}:\n\n")
 
             # Write each question and its answer to the text file
             for heading, question in zip(headings, questions):
                 answer = answers.get(question, "No answer found")
                 textfile.write(f"{heading}: {answer}\n")
+        os.replace(tmp_path, text_output_path)
 
         return text_output_path
     except Exception as e:
         logging.error(f"Error writing to file {file_path}: {e}")
         return None
 
+# Function to answer the questions for one embeddings file and write its summary.
+# Returns the summary path, or None if the file could not be answered.
+def summarise_file(file_path, questions, headings, summaries_out, pasqui_asks=pasqui_asks):
+    answers = process_file(file_path, questions, headings, pasqui_asks)
+    if not answers:
+        return None
+    return write_answers_to_file(os.path.basename(file_path), answers, questions, headings, summaries_out)
+
 # Function to accumulate results in a list
 def accumulate_results(file_name, headings, questions, answers, results):
     result = {'file_name': file_name}
@@ -148,13 +555,75 @@ def accumulate_results(file_name, headings, questions, answers, results):
         result[heading] = answer
     results.append(result)
 
-def pasqui_summarising(embeddings_dir, summaries_out, questions, headings, pasqui_asks, log_file_path):
+# Function to estimate the prompt tokens of answering every question for a file one by one:
+# each prompt holds the system message, the question and as much of the document as fits
+def estimate_request_tokens(file_path, questions, model=gpt):
+    counts = store.load_token_counts(file_path)
+    if counts is None:
+        counts = chunk_token_counts(load_embeddings(file_path)['text'].tolist(), model=model)
+    system_tokens = num_tokens(default_system_message, model=model)
+    return sum(min(token_budget, sum(counts) + num_tokens(question, model=model)) + system_tokens
+               for question in questions)
+
+# Function to link every embeddings table to the canonical table it duplicates, fingerprinting
+# the tables the index does not know yet from their chunk texts. Returns duplicate -> canonical file names.
+def find_duplicates(embeddings_dir, files, signatures_path=None, threshold=dedup.threshold):
+    index = dedup.SignatureIndex(signatures_path or os.path.join(embeddings_dir, dedup.signatures_name),
+                                 threshold=threshold)
+    duplicates = {}
+    try:
+        for file_name in files:
+            name = dedup.document_name(file_name)
+            if index.version(name) is None:
+                try:
+                    table = load_embeddings(os.path.join(embeddings_dir, file_name))
+                    index.add(name, '\n'.join(table['text']), version=dedup.file_version(
+                        os.path.join(embeddings_dir, file_name)))
+                except Exception as e:
+                    logging.error(f"Error fingerprinting {file_name}: {e}")
+                    continue
+            canonical, value = index.canonical(name)
+            if canonical is not None and canonical + '.csv' in files:
+                duplicates[file_name] = canonical + '.csv'
+                logging.info(f"{file_name} duplicates {canonical}.csv (similarity {value:.2f})")
+    finally:
+        index.close()
+    return duplicates
+
+# Chat answers are cached in embeddings_dir by default, so a rerun (after a crash, with a new
+# heading or another summaries_out) only pays for prompts it has not sent before.
+# With deduplicate, a file duplicating another one of embeddings_dir (see dedup.py) is given the
+# answers of that canonical file instead of being asked again.
+# With work_queue (a SQLite file, see workqueue.py) several processes or machines can summarise the
+# same embeddings_dir: each claims files from the queue and returns the results of the files it answered.
+# Failed files are retried once per run; pass the workers the same run_id (see LeaseQueue.enqueue).
+def pasqui_summarising(embeddings_dir, summaries_out, questions, headings, pasqui_asks, log_file_path,
+                       query_cache_path=None, query_cache_size=10000, max_workers=1,
+                       requests_per_minute=None, tokens_per_minute=None, cache_responses=True,
+                       response_cache_path=None, response_cache_size=100000, response_cache_ttl=None,
+                       deduplicate=False, dedup_threshold=dedup.threshold, signatures_path=None,
+                       work_queue=None, lease_seconds=300, run_id=None):
     # Call the setup_logging function
     setup_logging(log_file_path)
 
-    # List all files in the directory
-    files = list_files_in_directory(embeddings_dir)
-    print(f"Files found: {files}")  # Debugging step
+    # max_workers bounds both the files processed at once and the API requests in flight
+    configure_requests(max_in_flight=max_workers, requests_per_minute=requests_per_minute,
+                       tokens_per_minute=tokens_per_minute)
+
+    # Embed every question once for the whole run; each file (and later runs) then reuse the cached vectors
+    use_query_cache(query_cache_path or os.path.join(embeddings_dir, query_cache_name), max_entries=query_cache_size)
+    cache_start = query_cache.stats()
+    use_response_cache(response_cache_path or os.path.join(embeddings_dir, response_cache_name),
+                       max_entries=response_cache_size, ttl=response_cache_ttl, enabled=cache_responses)
+    try:
+        with telemetry.scope(stage='summarise'):
+            embed_queries(questions)
+    except Exception as e:
+        logging.error(f"Error embedding questions: {e}")
+
+    # List all embedding tables in the directory (.npy matrices are loaded alongside them)
+    files = [f for f in list_files_in_directory(embeddings_dir) if f.endswith('.csv')]
+    logging.info(f"{len(files)} files found in {embeddings_dir}")
 
     # Create output directory if it doesn't exist
     create_summaries_out(summaries_out)
@@ -162,20 +631,112 @@ def pasqui_summarising(embeddings_dir, summaries_out, questions, headings, pasqu
     # List to accumulate results
     results = []
 
-    # Iterate through each file in the directory
-    for file_name in files:
+    def answer_file(file_name):
         file_path = os.path.join(embeddings_dir, file_name)
-        print(f"Processing file: {file_path}")  # Debugging step
+        logging.debug(f"Processing file: {file_path}")
 
         # Process file and get answers
-        answers = process_file(file_path, questions, headings, pasqui_asks)
-
+        return process_file(file_path, questions, headings, pasqui_asks)
+
+    duplicates = find_duplicates(embeddings_dir, files, signatures_path, dedup_threshold) if deduplicate else {}
+
+    canonicals = set(duplicates.values())
+    answered = {}  # Answers of canonical files, kept for their duplicates
+    reused = []
+
+    def answer_files(batch):
+        """Yield (file name, answers) for every file of batch in order, each as soon as it is answered.
+
+        Files are answered concurrently; duplicates reuse their canonical file's answers (and are
+        asked themselves if it was not answered).
+        """
+        unique = [file_name for file_name in batch if file_name not in duplicates]
+        fresh = zip(unique, map_ordered(answer_file, unique, max_workers))
+        ready = {}  # Answered files of this batch not yielded yet
+
+        def answers_of(file_name):
+            while file_name not in ready:
+                name, answers = next(fresh)
+                ready[name] = answers
+                if name in canonicals:
+                    answered[name] = answers
+            return ready[file_name]
+
+        for file_name in batch:
+            if file_name not in duplicates:
+                answers_of(file_name)
+                yield file_name, ready.pop(file_name)
+                continue
+            canonical = duplicates[file_name]
+            if canonical in unique and canonical not in answered:
+                answers_of(canonical)
+            answers = answered.get(canonical)
+            if answers:
+                reused.append(file_name)
+                telemetry.count('pasqui_duplicates_total', stage='summarise', kind='document')
+                telemetry.count('pasqui_documents_total', stage='summarise', status='duplicate')
+            else:
+                answers = answer_file(file_name)
+                if file_name in canonicals:
+                    answered[file_name] = answers
+            yield file_name, answers
+
+    def write(file_name, answers):
         # Removed incorrect 'done' reference and prevented answers from printing
         # print(f"Generated answers: {answers}")  # Commented out to stop console output
 
         if answers:  # Only proceed if answers are returned
             base_name = file_name
-            write_answers_to_file(base_name, answers, questions, headings, summaries_out)
+            summary_path = write_answers_to_file(base_name, answers, questions, headings, summaries_out)
             accumulate_results(base_name, headings, questions, answers, results)
+            return summary_path
+
+    if work_queue:
+        queue = LeaseQueue(work_queue, lease_seconds=lease_seconds)
+        items = [(file_name, file_version(os.path.join(embeddings_dir, file_name))) for file_name in files]
+        try:
+            # Asking other questions, or into another folder, is a separate set of tasks
+            stage = stage_key('summarise', os.path.abspath(embeddings_dir), os.path.abspath(summaries_out),
+                              questions, headings)
+            for leases in queue.batches(stage, items, max(max_workers, 1) * 4, run=run_id):
+                for lease, (file_name, answers) in zip(leases, answer_files([lease.name for lease in leases])):
+                    summary_path = write(file_name, answers)
+                    if summary_path:
+                        queue.complete(lease, summary_path)
+                    else:
+                        queue.fail(lease, f"Could not summarise {file_name}")
+        finally:
+            queue.close()
+    else:
+        # Each file is written as soon as it is answered, so a crash only loses the files in flight
+        batch_size = max(max_workers, 1) * 4
+        for start in range(0, len(files), batch_size):
+            for file_name, answers in answer_files(files[start:start + batch_size]):
+                write(file_name, answers)
+
+    cache_end = query_cache.stats()
+    cache_report = (f"Query embedding cache: {cache_end['hits'] - cache_start['hits']} hits, "
+                    f"{cache_end['misses'] - cache_start['misses']} misses")
+    logging.info(cache_report)
+    print(cache_report)
+    if response_cache is not None:
+        responses = response_cache.stats()
+        response_report = (f"Response cache: {responses['hits']} hits, {responses['misses']} misses, "
+                           f"{responses['entries']} entries")
+        logging.info(response_report)
+        print(response_report)
+    if deduplicate:
+        avoided_tokens = 0
+        for file_name in reused:
+            try:
+                avoided_tokens += estimate_request_tokens(os.path.join(embeddings_dir, file_name), questions)
+            except Exception as e:
+                logging.error(f"Error estimating the tokens of {file_name}: {e}")
+        telemetry.count('pasqui_dedup_avoided_calls_total', len(reused) * len(questions), stage='summarise')
+        telemetry.count('pasqui_dedup_avoided_tokens_total', avoided_tokens, stage='summarise')
+        dedup_report = (f"Deduplication: {len(reused)} duplicate files reused their canonical answers, "
+                        f"about {len(reused) * len(questions)} API calls and {avoided_tokens} prompt tokens avoided")
+        logging.info(dedup_report)
+        print(dedup_report)
 
     return results  # Ensure return is the last statement
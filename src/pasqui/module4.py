@@ -1,34 +1,37 @@
 from kor.extraction import create_extraction_chain
 from kor.nodes import Object, Text, Number
 
-# LangChain Models
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import OpenAI
-from langchain_openai import ChatOpenAI
-
 # Standard Helpers
-import time
 import json
-from datetime import datetime
 import os
+import contextlib
+import logging
+import threading
 import openpyxl
-
-# For token counting
-from langchain.callbacks import get_openai_callback
+from . import telemetry
+from .cache import DiskCache, make_key
+from .clients import get_llm
+from .ratelimit import RequestThrottle, map_ordered
+from .tokens import num_tokens
+from .workqueue import LeaseQueue, temporary_path, file_version, stage_key
 
 gpt = "gpt-4o-mini"
 
-# Fetch API key from environment
-api_key = os.getenv("api_key")
-if not api_key:
-    raise ValueError("API key is required but not set. Use os.environ['api_key'] = 'your-key' before running.")
+# The chat model and the default chain are created on first use, so importing this module
+# needs no API key; `llm` and `chain` remain available as module attributes.
+_default_chain = None
+
+# Extraction outputs keyed by the full request (model settings and rendered prompt), so an
+# unchanged summary is never extracted twice; None disables it (see use_response_cache)
+response_cache = DiskCache(max_entries=10000)
+response_cache_name = ".pasqui_extractions.sqlite"  # Default file of pasqui_structuring, kept in summaries_out
 
-llm = ChatOpenAI(
-    model_name=gpt,
-    temperature=0,
-    max_tokens=2000,
-    openai_api_key=api_key
-)
+def __getattr__(name):
+    if name == 'llm':
+        return get_llm(gpt)
+    if name == 'chain':
+        return get_default_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Allow instruction to be overridden dynamically
 def get_chain(instruction=None):
@@ -40,10 +43,40 @@ def get_chain(instruction=None):
             description="Default extraction object",
             attributes=[]  # No attributes by default
         )
-    return create_extraction_chain(llm, instruction, encoder_or_encoder_class="csv")
+    return create_extraction_chain(get_llm(gpt), instruction, encoder_or_encoder_class="csv")
+
+def get_default_chain():
+    """Return the chain for the default instruction, compiled once."""
+    global _default_chain
+    if _default_chain is None:
+        _default_chain = get_chain()
+    return _default_chain
+
+def use_response_cache(path=None, max_entries=100000, ttl=None, enabled=True):
+    """Replace the extraction-output cache, persisting it to a SQLite file when a path is given.
+
+    Entries older than ttl seconds are ignored and dropped; enabled=False turns caching off.
+    """
+    global response_cache
+    response_cache = DiskCache(path, max_entries=max_entries, ttl=ttl) if enabled else None
+    return response_cache
 
-# Initialize with a default instruction
-chain = get_chain()
+def request_key(chain, text):
+    """Hash the full request a kor chain sends for a text, or return None for other chains."""
+    try:
+        prompt = chain.first.format_prompt(text=text).to_string()
+        llm = chain.middle[0] if chain.middle else chain.last
+    except (AttributeError, IndexError, KeyError):
+        return None
+    settings = [getattr(llm, name, None) for name in ('model_name', 'temperature', 'max_tokens')]
+    return make_key('extract', *settings, prompt)
+
+def usage_callback():
+    """Return LangChain's OpenAI token and cost counter while telemetry is enabled, else a no-op."""
+    if not telemetry.enabled:
+        return contextlib.nullcontext()
+    from langchain_community.callbacks import get_openai_callback
+    return get_openai_callback()
 
 def load_processed_files(log_file):
     """Load the list of processed files from the log file."""
@@ -64,85 +97,304 @@ def handle_value(value):
         return ', '.join(map(str, value))
     return value if value else "NA"
 
-def pasqui_structuring(summaries_out, results_file, errors_file, log_file, headers_vars, instruction=None):
-    """Process text files and structure results into an Excel file."""
+def journal_path(results_file):
+    """Return the path of the append-only journal kept next to the results workbook."""
+    return os.path.splitext(results_file)[0] + '.jsonl'
 
-    # Load already processed files
-    processed_files = load_processed_files(log_file)
+def read_journal(path):
+    """Yield the records of a journal, skipping a line left half-written by a crash."""
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
 
-    # Check if the workbook already exists
-    if os.path.exists(results_file):
-        wb = openpyxl.load_workbook(results_file)
-        results_sheet = wb.get_sheet_by_name("Results")
-        errors_sheet = wb.get_sheet_by_name("Errors")
-    else:
-        wb = openpyxl.Workbook()
-        results_sheet = wb.active
-        results_sheet.title = "Results"
-        errors_sheet = wb.create_sheet(title="Errors")
-        results_sheet.append(headers_vars)
-        errors_sheet.append(["Error Files"])
+def write_workbook(results_file, headers_vars, file_rows, failed):
+    """Write (filename, rows) pairs, then the failed filenames, to the workbook, replacing it atomically.
 
-    error_files = []
-    new_processed_files = set()
+    file_rows may be a generator; failed is only read once it is exhausted.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    results_sheet = wb.create_sheet(title="Results")
+    errors_sheet = wb.create_sheet(title="Errors")
+    results_sheet.append(headers_vars)
+    errors_sheet.append(["Error Files"])
+    for _, rows in file_rows:
+        for row in rows:
+            results_sheet.append(row)
+    for filename in failed:
+        errors_sheet.append([filename])
 
-    # Get and sort text files
-    files = sorted([f for f in os.listdir(summaries_out) if f.endswith(".txt")])
+    # Replace the workbook atomically so a crash never leaves it half-written
+    tmp_file = temporary_path(results_file) + '.xlsx'
+    wb.save(tmp_file)
+    os.replace(tmp_file, results_file)
 
-    # Create a new chain if an instruction override is provided
-    local_chain = get_chain(instruction) if instruction else chain
+class ResultSink:
+    """Append-only JSONL journal of extraction results, exported to the xlsx workbook on demand.
+
+    Each file's rows are appended and fsynced to the journal before the file is added to
+    log_file, so per-file cost stays constant however large the output grows. On restart,
+    files found in the journal but missing from log_file are logged, so none is done twice.
+    """
+
+    def __init__(self, results_file, log_file, headers_vars):
+        self.results_file = results_file
+        self.log_file = log_file
+        self.headers_vars = headers_vars
+        self.path = journal_path(results_file)
+
+        # Seed the journal from a workbook written before journals existed
+        if not os.path.exists(self.path) and os.path.exists(results_file):
+            self._import_workbook()
+        self._truncate_partial_line()
+
+        done = {record['file'] for record in read_journal(self.path) if 'rows' in record}
+        logged = load_processed_files(log_file)
+        update_processed_files(log_file, sorted(done - logged))
+        self.processed = logged | done
+        self._journal = open(self.path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _import_workbook(self):
+        wb = openpyxl.load_workbook(self.results_file, read_only=True)
+        rows = {}
+        for row in wb["Results"].iter_rows(min_row=2, values_only=True):
+            rows.setdefault(row[0], []).append(list(row))
+        errors = [row[0] for row in wb["Errors"].iter_rows(min_row=2, values_only=True)]
+        wb.close()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for filename, file_rows in rows.items():
+                f.write(json.dumps({"file": filename, "rows": file_rows}) + '\n')
+            for filename in errors:
+                f.write(json.dumps({"file": filename, "error": ""}) + '\n')
+
+    def _truncate_partial_line(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def add(self, filename, rows):
+        """Record the rows extracted from a file and mark it as processed."""
+        with self._lock:
+            self._append({"file": filename, "rows": rows})
+            update_processed_files(self.log_file, [filename])
+            self.processed.add(filename)
+
+    def add_error(self, filename, error):
+        """Record a file that failed; it is retried on the next run."""
+        with self._lock:
+            self._append({"file": filename, "error": str(error)})
+
+    def export(self):
+        """Write every journaled row to the workbook with openpyxl's write-only mode."""
+        with self._lock:
+            self._journal.flush()
+
+        # The journal is read once: failures are collected while its rows are written
+        failed = {}
+
+        def rows():
+            for record in read_journal(self.path):
+                if 'rows' in record:
+                    failed.pop(record['file'], None)  # Succeeded on a later run
+                    yield record['file'], record['rows']
+                else:
+                    failed[record['file']] = True
 
-    for filename in files:
-        if filename not in processed_files:
-            file_path = os.path.join(summaries_out, filename)
+        write_workbook(self.results_file, self.headers_vars, rows(), failed)
+
+    def close(self):
+        self._journal.close()
+
+def rows_from_output(filename, output, headers_vars):
+    """Turn the extraction output for a file into Results rows (one row of NA if nothing was found)."""
+    data = output.get('data', {})
+    # Dynamically find the first key in the extracted data
+    first_key = next(iter(data.keys()), None)
+    instruction_list = data.get(first_key, []) if first_key else []
+
+    rows = []
+    for instruction in instruction_list:
+        row = [filename]
+        for header in headers_vars[1:]:
+            value = instruction.get(header)
+            row.append(handle_value(value))
+        rows.append(row)
+    if not rows:
+        rows.append([filename] + ["NA"] * (len(headers_vars) - 1))
+    return rows
+
+def extract_file(chain, file_path, throttle=None):
+    """Run the extraction chain on one text file, returning (output, error).
+
+    Outputs are served from and saved to response_cache when it is enabled.
+    """
+    with telemetry.scope(stage='structure', document=os.path.basename(file_path)), \
+            telemetry.timer('pasqui_document_seconds'):
+        try:
             with open(file_path, 'r', encoding='utf-8') as file:
                 text = file.read()
-                input_data = {"text": text}
 
-                try:
-                    # Process with LangChain extraction
-                    output = local_chain.invoke(input_data)
-                    print(f"Output for {filename}: {output}")
+            cache = response_cache
+            key = request_key(chain, text) if cache is not None else None
+            if key is not None:
+                cached = cache.get(key)
+                if cached is not None:
+                    telemetry.count('pasqui_cache_hits_total', cache='extractions')
+                    return json.loads(cached), None
+                telemetry.count('pasqui_cache_misses_total', cache='extractions')
+
+            input_data = {"text": text}
+            with usage_callback() as usage:
+                if throttle is None:
+                    output = chain.invoke(input_data)
+                else:
+                    tokens = num_tokens(text) if throttle.tokens else 0
+                    output = throttle.call(chain.invoke, input_data, tokens=tokens, operation='extraction')
+            if usage is not None:
+                telemetry.count('pasqui_tokens_total', usage.prompt_tokens, kind='prompt', operation='extraction')
+                telemetry.count('pasqui_tokens_total', usage.completion_tokens, kind='completion',
+                                operation='extraction')
+                telemetry.count('pasqui_cost_usd_total', usage.total_cost, operation='extraction')
+
+            # Only clean outputs are cached, so a failed parse is retried on the next run
+            if key is not None and isinstance(output, dict) and not output.get('errors'):
+                cache.set(key, json.dumps(output, default=str))
+            return output, None
+        except Exception as e:
+            return None, e
+
+def pasqui_structuring(summaries_out, results_file, errors_file, log_file, headers_vars, instruction=None,
+                       max_workers=1, requests_per_minute=None, tokens_per_minute=None, export_every=None,
+                       cache_responses=True, response_cache_path=None, response_cache_size=100000,
+                       response_cache_ttl=None, work_queue=None, lease_seconds=300, run_id=None):
+    """Process text files and structure results into an Excel file.
+
+    Up to max_workers files are extracted concurrently within the per-minute budgets;
+    results are still written in sorted filename order. Rows are appended to a JSONL journal
+    next to results_file and exported to the workbook every export_every files and at the end.
+    Extraction outputs are cached in summaries_out by default, so a rerun into a fresh results
+    file only pays for summaries that changed.
+
+    With work_queue (a SQLite file, see workqueue.py) several processes or machines can structure
+    the same summaries_out: files already in log_file or the journal are skipped, each worker claims
+    files from the queue and commits their rows to it, and once it is drained a single worker adds
+    the new rows to the journal and log_file and exports the workbook.
+    Failed files are retried once per run; pass the workers the same run_id (see LeaseQueue.enqueue).
+    """
+    use_response_cache(response_cache_path or os.path.join(summaries_out, response_cache_name),
+                       max_entries=response_cache_size, ttl=response_cache_ttl, enabled=cache_responses)
 
-                    data = output.get('data', {})
-                    # Dynamically find the first key in the extracted data
-                    first_key = next(iter(data.keys()), None)
-                    instruction_list = data.get(first_key, []) if first_key else []
+    # Get and sort text files
+    files = sorted([f for f in os.listdir(summaries_out) if f.endswith(".txt")])
+
+    # Create a new chain if an instruction override is provided
+    local_chain = get_chain(instruction) if instruction else get_default_chain()
+
+    throttle = RequestThrottle(max_in_flight=max_workers, requests_per_minute=requests_per_minute,
+                               tokens_per_minute=tokens_per_minute)
+    batch_size = max(max_workers, 1) * 4
+
+    def extract_batch(batch):
+        return map_ordered(
+            lambda filename: extract_file(local_chain, os.path.join(summaries_out, filename), throttle),
+            batch, max_workers,
+        )
 
+    if work_queue:
+        queue = LeaseQueue(work_queue, lease_seconds=lease_seconds)
+        # Read only: the journal and log_file are written by the worker that exports, see below
+        processed_files = load_processed_files(log_file) | \
+            {record['file'] for record in read_journal(journal_path(results_file)) if 'rows' in record}
+        items = [(filename, file_version(os.path.join(summaries_out, filename)))
+                 for filename in files if filename not in processed_files]
+        stage = stage_key('structure', os.path.abspath(summaries_out), os.path.abspath(results_file), headers_vars,
+                          instruction)
+        try:
+            for leases in queue.batches(stage, items, batch_size, run=run_id):
+                batch = [lease.name for lease in leases]
+                for lease, filename, (output, error) in zip(leases, batch, extract_batch(batch)):
+                    try:
+                        if error is not None:
+                            raise error
+                        logging.debug(f"Output for {filename}: {output}")
+                        telemetry.event('extraction_output', stage='structure', document=filename, output=output)
+                        # The rows are the task's artefact, so a file is committed exactly once
+                        queue.complete(lease, json.dumps(rows_from_output(filename, output, headers_vars)))
+                        telemetry.count('pasqui_documents_total', stage='structure', status='done')
+                    except Exception as e:
+                        logging.error(f"Error processing file {filename}: {e}")
+                        telemetry.count('pasqui_documents_total', stage='structure', status='failed')
+                        queue.fail(lease, e)
 
-                    if instruction_list:
-                        for instruction in instruction_list:
-                            row = [filename]
-                            for header in headers_vars[1:]:
-                                value = instruction.get(header)
-                                row.append(handle_value(value))
-                            results_sheet.append(row)
+            # Reconciling is a task of its own, done once per run: one worker writes the journal,
+            # log_file and workbook while the others wait
+            done, failed = queue.results(stage), queue.results(stage, 'failed')
+            for leases in queue.batches(stage_key('structure-export', stage), [('workbook', None)], redo=True,
+                                        run=run_id):
+                sink = ResultSink(results_file, log_file, headers_vars)
+                try:
+                    for filename, rows in done.items():
+                        if filename not in sink.processed:
+                            sink.add(filename, json.loads(rows))
+                    for filename, error in failed.items():
+                        if filename not in sink.processed:
+                            sink.add_error(filename, error)
+                    sink.export()
+                finally:
+                    sink.close()
+                queue.complete(leases[0])
+        finally:
+            queue.close()
+    else:
+        # Load already processed files (the log plus anything journaled before a crash)
+        sink = ResultSink(results_file, log_file, headers_vars)
+        processed_files = sink.processed
+        pending = [filename for filename in files if filename not in processed_files]
+        written = 0
 
-                        # Debugging: Print rows after appending to the sheet
-                        print("Data being written to sheet:")
-                        for row in results_sheet.iter_rows(values_only=True):
-                            print(row)  # Debugging to see what has been appended
+        # Extract a batch of files concurrently, then write the batch in order before the next one
+        for batch_start in range(0, len(pending), batch_size):
+            batch = pending[batch_start:batch_start + batch_size]
+            extracted = extract_batch(batch)
 
-                        wb.save(results_file)  # Save after every iteration
+            for filename, (output, error) in zip(batch, extracted):
+                try:
+                    if error is not None:
+                        raise error
 
-                    else:
-                        results_sheet.append([filename] + ["NA"] * (len(headers_vars) - 1))
+                    # Process with LangChain extraction
+                    logging.debug(f"Output for {filename}: {output}")
+                    telemetry.event('extraction_output', stage='structure', document=filename, output=output)
 
-                    new_processed_files.add(filename)
-                    wb.save(results_file)
-                    update_processed_files(log_file, {filename})
+                    sink.add(filename, rows_from_output(filename, output, headers_vars))
+                    telemetry.count('pasqui_documents_total', stage='structure', status='done')
+                    written += 1
+                    if export_every and written % export_every == 0:
+                        sink.export()
 
                 except Exception as e:
-                    print(f"Error processing file {filename}: {e}")
-                    error_files.append([filename])
+                    logging.error(f"Error processing file {filename}: {e}")
+                    telemetry.count('pasqui_documents_total', stage='structure', status='failed')
+                    sink.add_error(filename, e)
 
-    for filename in error_files:
-        errors_sheet.append(filename)
+        sink.export()
+        sink.close()
 
-    wb.save(results_file)
-    wb.close()
-    update_processed_files(log_file, new_processed_files)
-    
+    if response_cache is not None:
+        responses = response_cache.stats()
+        print(f"Extraction cache: {responses['hits']} hits, {responses['misses']} misses, "
+              f"{responses['entries']} entries")
     print(f"Results saved to {results_file}")
     print(f"Errors saved to {errors_file}")
-
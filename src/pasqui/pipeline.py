@@ -0,0 +1,296 @@
+import os
+import time
+import functools
+import queue
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from . import module1, module2, module3, module4
+from .cache import DiskCache
+from .ratelimit import RequestThrottle
+
+stages = ('convert', 'embed', 'summarise', 'structure')
+
+default_workers = {'convert': os.cpu_count() or 1, 'embed': 4, 'summarise': 4, 'structure': 4}
+
+class Checkpoint:
+    """SQLite record of the last stage each document completed and the artefact it produced."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS documents (
+            name TEXT PRIMARY KEY, version TEXT, stage TEXT, artefact TEXT, error TEXT)''')
+        self._conn.commit()
+
+    def load(self):
+        """Return a dict of name -> (version, last completed stage, artefact)."""
+        with self._lock:
+            rows = self._conn.execute('SELECT name, version, stage, artefact FROM documents').fetchall()
+        return {name: (version, stage, artefact) for name, version, stage, artefact in rows}
+
+    def record(self, name, version, stage, artefact):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, NULL)',
+                               (name, version, stage, artefact))
+            self._conn.commit()
+
+    def fail(self, name, error):
+        with self._lock:
+            self._conn.execute('UPDATE documents SET error = ? WHERE name = ?', (str(error), name))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class Pipeline:
+    """Streams every document of input_dir through convert -> embed -> summarise -> structure.
+
+    Stages run concurrently with their own worker count and are connected by bounded queues, so a
+    document reaches the results workbook without waiting for the rest of the corpus. Each stage
+    a document completes is checkpointed in work_dir, and a restarted run resumes every document
+    at the stage after its last completed one. Chat answers and extraction outputs are cached in
+    work_dir unless cache_responses is False. With packed_questions, questions whose retrieved
+    context overlaps are asked in one request (see module3.pasqui_asks).
+    """
+
+    def __init__(self, input_dir, work_dir, questions, headings, headers_vars, instruction=None,
+                 workers=None, queue_size=8, keep_intermediate=True, page_range=None, page_timeout=None,
+                 requests_per_minute=None, tokens_per_minute=None, export_every=100, cache_responses=True,
+                 progress_interval=30, on_progress=None, packed_questions=False):
+        self.input_dir = input_dir
+        self.work_dir = work_dir
+        self.questions = questions
+        self.headings = headings
+        self.headers_vars = headers_vars
+        self.instruction = instruction
+        self.workers = dict(default_workers, **(workers or {}))
+        self.queue_size = queue_size
+        self.keep_intermediate = keep_intermediate
+        self.page_range = page_range
+        self.page_timeout = page_timeout
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.export_every = export_every
+        self.cache_responses = cache_responses
+        self.progress_interval = progress_interval
+        self.on_progress = on_progress
+        self.pasqui_asks = functools.partial(module3.pasqui_asks, packed=True) if packed_questions else module3.pasqui_asks
+
+        self.dirs = {stage: os.path.join(work_dir, name) for stage, name in
+                     (('convert', 'texts'), ('embed', 'embeddings'), ('summarise', 'summaries'))}
+        self.results_file = os.path.join(work_dir, 'results.xlsx')
+        self.log_file = os.path.join(work_dir, 'structured.log')
+        self.errors_file = os.path.join(work_dir, 'errors.log')
+
+        self._lock = threading.Lock()
+        self._counters = {stage: {'done': 0, 'failed': 0, 'active': 0, 'busy_s': 0.0} for stage in stages}
+        self._queues = {stage: queue.Queue(maxsize=queue_size) for stage in stages}
+        self._started = None
+
+    # Progress -----------------------------------------------------------------------------
+
+    def stats(self):
+        """Return per-stage done, failed, active and queued counts and documents per second."""
+        elapsed = max(time.monotonic() - (self._started or time.monotonic()), 1e-9)
+        with self._lock:
+            return {stage: dict(self._counters[stage], queued=self._queues[stage].qsize(),
+                                docs_per_s=self._counters[stage]['done'] / elapsed)
+                    for stage in stages}
+
+    def report(self):
+        """Log and print a one-line progress summary."""
+        stats = self.stats()
+        if self.on_progress:
+            self.on_progress(stats)
+        line = ' | '.join(f"{stage}: {s['done']} done, {s['failed']} failed, {s['active']} active, "
+                          f"{s['queued']} queued, {s['docs_per_s']:.2f}/s" for stage, s in stats.items())
+        logging.info(line)
+        print(line)
+
+    def _monitor(self, stop):
+        while not stop.wait(self.progress_interval):
+            self.report()
+
+    # Stages -------------------------------------------------------------------------------
+
+    def _convert(self, name, artefact):
+        future = self._pool.submit(module1.convert_file, artefact, self.dirs['convert'],
+                                   self.page_range, self.page_timeout)
+        _, output_path, _, skipped = future.result()
+        for page, reason in skipped:
+            self._log_error(f"Skipped page {page} of {name}: {reason}")
+        if not output_path:
+            raise ValueError(f"Could not process: {name}")
+        return output_path
+
+    def _embed(self, name, artefact):
+        return module2.embed_file(artefact, self.dirs['embed'], self._embedding_cache)
+
+    def _summarise(self, name, artefact):
+        summary_path = module3.summarise_file(artefact, self.questions, self.headings, self.dirs['summarise'],
+                                              self.pasqui_asks)
+        if not summary_path:
+            raise ValueError(f"Could not summarise: {name}")
+        return summary_path
+
+    def _structure(self, name, artefact):
+        filename = os.path.basename(artefact)
+        if filename not in self._sink.processed:  # Already journaled before a crash
+            output, error = module4.extract_file(self._chain, artefact, self._structure_throttle)
+            if error is not None:
+                self._sink.add_error(filename, error)
+                raise error
+            self._sink.add(filename, module4.rows_from_output(filename, output, self.headers_vars))
+            with self._lock:
+                structured = self._counters['structure']['done'] + 1
+            if self.export_every and structured % self.export_every == 0:
+                self._sink.export()
+        return self.results_file
+
+    def _discard(self, stage, artefact):
+        """Delete the intermediate files a stage read, once its result is checkpointed."""
+        if self.keep_intermediate or stage == 'convert':  # Input documents are never deleted
+            return
+        for path in (artefact, module2.matrix_path(artefact)) if stage == 'summarise' else (artefact,):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _log_error(self, message):
+        with self._lock:
+            with open(self.errors_file, 'a') as error_log:
+                error_log.write(message + '\n')
+
+    def _work(self, index):
+        stage = stages[index]
+        run = getattr(self, f'_{stage}')
+        inbox = self._queues[stage]
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            name, version, artefact = item
+            with self._lock:
+                self._counters[stage]['active'] += 1
+            start = time.monotonic()
+            try:
+                result = run(name, artefact)
+            except Exception as e:
+                with self._lock:
+                    self._counters[stage]['failed'] += 1
+                self._checkpoint.fail(name, f"{stage}: {e}")
+                self._log_error(f"{stage} failed for {name}: {e}")
+                logging.error(f"{stage} failed for {name}: {e}")
+                continue
+            finally:
+                with self._lock:
+                    self._counters[stage]['active'] -= 1
+                    self._counters[stage]['busy_s'] += time.monotonic() - start
+
+            self._checkpoint.record(name, version, stage, result)
+            self._discard(stage, artefact)
+            with self._lock:
+                self._counters[stage]['done'] += 1
+            if index + 1 < len(stages):
+                self._queues[stages[index + 1]].put((name, version, result))
+
+    # Run ----------------------------------------------------------------------------------
+
+    def _plan(self):
+        """Return, per stage, the documents that resume at that stage."""
+        checkpoints = self._checkpoint.load()
+        plan = {stage: [] for stage in stages}
+        for filename in sorted(os.listdir(self.input_dir)):
+            if not filename.endswith(('.pdf', '.docx')):
+                continue
+            path = os.path.join(self.input_dir, filename)
+            stat = os.stat(path)
+            version = f"{stat.st_size}:{stat.st_mtime}"
+            saved = checkpoints.get(filename)
+            if saved and saved[0] == version:
+                next_stage = stages.index(saved[1]) + 1
+                if next_stage == len(stages):
+                    continue
+                if os.path.exists(saved[2]):
+                    plan[stages[next_stage]].append((filename, version, saved[2]))
+                    continue
+                # The artefact the next stage needs is gone (e.g. deleted by hand): start over
+                logging.warning(f"{saved[2]} of {filename} is missing, converting it again")
+            plan['convert'].append((filename, version, path))
+        return plan
+
+    def run(self):
+        """Run the pipeline to completion and return the final per-stage stats."""
+        for directory in self.dirs.values():
+            os.makedirs(directory, exist_ok=True)
+        self._checkpoint = Checkpoint(os.path.join(self.work_dir, 'pipeline.sqlite'))
+        self._embedding_cache = DiskCache(os.path.join(self.dirs['embed'], module2.cache_name), max_entries=None)
+        self._sink = module4.ResultSink(self.results_file, self.log_file, self.headers_vars)
+        self._chain = module4.get_chain(self.instruction) if self.instruction else module4.get_default_chain()
+
+        limits = dict(requests_per_minute=self.requests_per_minute, tokens_per_minute=self.tokens_per_minute)
+        module2.throttle = RequestThrottle(max_in_flight=self.workers['embed'], **limits)
+        module3.configure_requests(max_in_flight=self.workers['summarise'], **limits)
+        self._structure_throttle = RequestThrottle(max_in_flight=self.workers['structure'], **limits)
+        module3.use_query_cache(os.path.join(self.work_dir, module3.query_cache_name))
+        for module in (module3, module4):
+            module.use_response_cache(os.path.join(self.work_dir, module.response_cache_name),
+                                      enabled=self.cache_responses)
+
+        plan = self._plan()
+        self._started = time.monotonic()
+        stop = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(stop,), daemon=True)
+        monitor.start()
+
+        with ProcessPoolExecutor(max_workers=self.workers['convert']) as self._pool:
+            threads = {stage: [threading.Thread(target=self._work, args=(i,), daemon=True)
+                               for _ in range(max(self.workers[stage], 1))]
+                       for i, stage in enumerate(stages)}
+            for stage_threads in threads.values():
+                for thread in stage_threads:
+                    thread.start()
+
+            # Feed resumed documents first (latest stage first), then new ones
+            def feed():
+                for stage in reversed(stages):
+                    for item in plan[stage]:
+                        self._queues[stage].put(item)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            feeder.join()
+
+            # A stage is closed once everything upstream of it has finished
+            for stage in stages:
+                for _ in threads[stage]:
+                    self._queues[stage].put(None)
+                for thread in threads[stage]:
+                    thread.join()
+
+        stop.set()
+        self._sink.export()
+        self._sink.close()
+        self._embedding_cache.close()
+        self._checkpoint.close()
+        self.report()
+        return self.stats()
+
+def pasqui_pipeline(input_dir, work_dir, questions, headings, headers_vars, instruction=None, workers=None,
+                    queue_size=8, keep_intermediate=True, page_range=None, page_timeout=None,
+                    requests_per_minute=None, tokens_per_minute=None, cache_responses=True, progress_interval=30,
+                    on_progress=None, packed_questions=False):
+    """Stream every PDF/DOCX of input_dir through conversion, embedding, summarising and structuring.
+
+    Outputs go to work_dir (texts/, embeddings/, summaries/, results.xlsx). workers maps each stage
+    to its worker count; progress is printed every progress_interval seconds and passed to on_progress.
+    """
+    pipeline = Pipeline(input_dir, work_dir, questions, headings, headers_vars, instruction=instruction,
+                        workers=workers, queue_size=queue_size, keep_intermediate=keep_intermediate,
+                        page_range=page_range, page_timeout=page_timeout,
+                        requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                        cache_responses=cache_responses, progress_interval=progress_interval, on_progress=on_progress,
+                        packed_questions=packed_questions)
+    return pipeline.run()
@@ -0,0 +1,124 @@
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from . import telemetry
+
+def map_ordered(fn, items, max_workers=1):
+    """Apply fn to every item with up to max_workers threads, yielding results in input order.
+
+    Like executor.map, each result is yielded as soon as it and those before it are ready, so the
+    caller can save it before the rest are done. Each call runs in a copy of the caller's context,
+    so telemetry scopes carry over to the threads.
+    """
+    items = list(items)
+    if max_workers is None or max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        yield from executor.map(lambda item: context.copy().run(fn, item), items)
+
+def is_retryable(error):
+    """Return True for rate-limit (429), server (5xx), timeout and connection errors."""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError') or isinstance(error, (ConnectionError, TimeoutError))
+
+def retry_after(error):
+    """Return the delay the server asked for in a Retry-After header, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Budget of `per_minute` units refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount):
+        """Refill the bucket and return how long to wait before `amount` is available."""
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) * 60 / self.capacity
+
+class RequestThrottle:
+    """Bounds in-flight API requests and their rate, retrying 429/5xx responses with exponential backoff."""
+
+    def __init__(self, max_in_flight=None, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, base_delay=1, max_delay=60):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.retries = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._lock = threading.Lock()
+
+    def wait_for_budget(self, tokens=0):
+        """Block until one request of `tokens` tokens fits in the per-minute budgets, then spend it."""
+        waited = 0
+        while True:
+            with self._lock:
+                wait = 0
+                if self.requests:
+                    wait = max(wait, self.requests.wait_time(1))
+                if self.tokens:
+                    wait = max(wait, self.tokens.wait_time(tokens))
+                if wait == 0:
+                    if self.requests:
+                        self.requests.available -= 1
+                    if self.tokens:
+                        self.tokens.available -= min(tokens, self.tokens.capacity)
+                    break
+            time.sleep(wait)
+            waited += wait
+        telemetry.count('pasqui_throttle_wait_seconds_total', waited)
+
+    def call(self, fn, *args, tokens=0, operation='request', **kwargs):
+        """Call fn(*args, **kwargs) within the budgets, retrying retryable errors.
+
+        Calls, retries, errors, latency and reported token usage are recorded in telemetry under operation.
+        """
+        attempt = 0
+        while True:
+            self.wait_for_budget(tokens)
+            if self._slots:
+                self._slots.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                telemetry.observe('pasqui_api_seconds', time.perf_counter() - start, operation=operation)
+                telemetry.count('pasqui_api_calls_total', operation=operation)
+                telemetry.record_usage(getattr(result, 'usage', None), operation=operation)
+                return result
+            except Exception as e:
+                telemetry.count('pasqui_api_errors_total', operation=operation)
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+                with self._lock:
+                    self.retries += 1
+                telemetry.count('pasqui_api_retries_total', operation=operation)
+            finally:
+                if self._slots:
+                    self._slots.release()
+            attempt += 1
+            time.sleep(delay)
@@ -0,0 +1,106 @@
+import os
+import ast
+import shutil
+import weakref
+import threading
+import numpy as np
+import pandas as pd
+from .workqueue import temporary_path
+
+# Embeddings are stored as two files per document:
+#   <name>.csv -> text table, one row per chunk (no vectors), with its token count when known
+#   <name>.npy -> float32 matrix, one row per chunk, memory-mapped on load
+# The .csv is still the file pasqui_summarising and pasqui_asks are pointed at,
+# so output folders written before the binary format keep working.
+
+# Arrays derived from a loaded DataFrame (its matrix, norms, token counts), keyed by id(df) and
+# dropped with the frame. They are not kept in df.attrs: pandas deep-copies attrs onto every
+# derived object, so df['text'] or df.iloc[...] would copy the memory-mapped matrix each time.
+_frame_data = {}
+_frame_lock = threading.Lock()
+
+def frame_data(df):
+    """Return the dict of arrays cached for a DataFrame, empty until something is stored in it."""
+    key = id(df)
+    with _frame_lock:
+        entry = _frame_data.get(key)
+        if entry is None or entry[0]() is not df:
+            def forget(ref, key=key):
+                with _frame_lock:
+                    if key in _frame_data and _frame_data[key][0] is ref:
+                        del _frame_data[key]
+            entry = (weakref.ref(df, forget), {})
+            _frame_data[key] = entry
+        return entry[1]
+
+def matrix_path(table_path):
+    """Return the path of the binary matrix stored next to a text table."""
+    return os.path.splitext(table_path)[0] + '.npy'
+
+def save_embeddings(table_path, texts, embeddings, token_counts=None):
+    """Write chunk texts (and their token counts) to a table and their vectors to a float32 .npy matrix."""
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2:
+        matrix = matrix.reshape(len(texts), -1)
+
+    # Write the matrix first so a table never points at a missing matrix
+    tmp_matrix = temporary_path(matrix_path(table_path))
+    with open(tmp_matrix, 'wb') as f:
+        np.save(f, matrix)
+    os.replace(tmp_matrix, matrix_path(table_path))
+
+    tmp_table = temporary_path(table_path)
+    table = pd.DataFrame({"text": list(texts)})
+    if token_counts is not None:
+        table["n_tokens"] = list(token_counts)
+    table.to_csv(tmp_table, index=False)
+    os.replace(tmp_table, table_path)
+
+def copy_embeddings(source_table, table_path):
+    """Copy a document's table and matrix to another table path (e.g. to reuse them for a duplicate)."""
+    for source, target in ((matrix_path(source_table), matrix_path(table_path)), (source_table, table_path)):
+        if not os.path.exists(source):
+            continue  # Legacy tables have no matrix
+        tmp_path = temporary_path(target)
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+def load_token_counts(table_path):
+    """Return the stored token count of every chunk of a table, or None if it was written without them."""
+    df = pd.read_csv(table_path, keep_default_na=False)
+    return [int(count) for count in df['n_tokens']] if 'n_tokens' in df.columns else None
+
+def load_embeddings(table_path):
+    """Load a text table and its embeddings, memory-mapping the matrix when present."""
+    path = matrix_path(table_path)
+    if os.path.exists(path):
+        df = pd.read_csv(table_path, keep_default_na=False)
+        matrix = np.load(path, mmap_mode='r')
+        # Each row is a view into the memory map, nothing is copied
+        df['embedding'] = list(matrix)
+        frame_data(df)['embedding_matrix'] = matrix
+        return df
+
+    # Legacy format: vectors stored as stringified Python lists in the table
+    df = pd.read_csv(table_path)
+    df['embedding'] = df['embedding'].apply(ast.literal_eval).apply(np.array)
+    return df
+
+def convert_embeddings_csv(folder_path):
+    """Convert legacy stringified-list CSV outputs of pasqui_embedding to the binary format."""
+    converted = []
+    for file in sorted(os.listdir(folder_path)):
+        if not file.endswith('.csv'):
+            continue
+        table_path = os.path.join(folder_path, file)
+        try:
+            df = pd.read_csv(table_path)
+            if 'embedding' not in df.columns:
+                continue  # Already converted
+            embeddings = [ast.literal_eval(e) for e in df['embedding']]
+            save_embeddings(table_path, df['text'].tolist(), embeddings)
+            converted.append(table_path)
+            print(f"Converted {table_path}")
+        except Exception as e:
+            print(f"Error converting {table_path}: {e}")
+    return converted
@@ -0,0 +1,227 @@
+import json
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# Metrics are off by default: every recording function returns immediately until enable() is called,
+# and timers/scopes hand back a shared no-op context manager.
+enabled = False
+_registry = None
+_callbacks = []
+
+# The stage and document the current code is working for, so API calls, tokens and cache hits
+# recorded deep inside a request are attributed to them (see scope)
+_scope = contextvars.ContextVar('pasqui_scope', default={})
+_noop = contextlib.nullcontext()
+
+# Upper bounds, in seconds, of the latency histogram buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def series_name(name, labels):
+    """Return a metric name with its labels, e.g. pasqui_tokens_total{kind=prompt,operation=chat}."""
+    if not labels:
+        return name
+    return name + '{' + ','.join(f"{k}={v}" for k, v in labels) + '}'
+
+class Registry:
+    """Counters and latency histograms keyed by metric name and labels, with per-document totals.
+
+    Stage-level series carry the labels they were recorded with except `document`, which only
+    feeds the per-document totals so the exported series stay few.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value, labels, document=None):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if document is not None:
+                totals = self.documents.setdefault(document, {})
+                total = series_name(*key)
+                totals[total] = totals.get(total, 0) + value
+
+    def observe(self, name, seconds, labels, document=None):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                                    'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            histogram['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+            if document is not None:
+                totals = self.documents.setdefault(document, {})
+                total = series_name(*key)
+                totals[total] = totals.get(total, 0) + seconds
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.documents.clear()
+
+    def snapshot(self):
+        """Return every series and the per-document totals as plain JSON-serialisable data."""
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': h['count'], 'sum': h['sum'],
+                                'max': h['max'], 'buckets': dict(zip([*map(str, self.buckets), '+Inf'],
+                                                                     h['buckets']))}
+                               for (name, labels), h in sorted(self.histograms.items())],
+                'documents': {document: dict(totals) for document, totals in sorted(self.documents.items())},
+            }
+
+    def to_json(self, path=None):
+        """Return the snapshot as JSON, also writing it to path when given."""
+        text = json.dumps(self.snapshot(), indent=2)
+        if path:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self):
+        """Return the stage-level series in the Prometheus text exposition format."""
+        def series(name, labels, suffix='', extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return f"{name}{suffix}"
+            body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+            return f"{name}{suffix}{{{body}}}"
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                typed.add(counter['name'])
+                lines.append(f"# TYPE {counter['name']} counter")
+            lines.append(f"{series(counter['name'], counter['labels'].items())} {counter['value']}")
+        for h in snapshot['histograms']:
+            if h['name'] not in typed:
+                typed.add(h['name'])
+                lines.append(f"# TYPE {h['name']} histogram")
+            cumulative = 0
+            for bound, count in h['buckets'].items():
+                cumulative += count
+                lines.append(f"{series(h['name'], h['labels'].items(), '_bucket', [('le', bound)])} {cumulative}")
+            lines.append(f"{series(h['name'], h['labels'].items(), '_sum')} {h['sum']}")
+            lines.append(f"{series(h['name'], h['labels'].items(), '_count')} {h['count']}")
+        return '\n'.join(lines) + '\n'
+
+def enable(registry=None, callbacks=()):
+    """Start recording into registry (a new Registry by default) and return it.
+
+    Every callback is called as callback(kind, name, value, labels) for each counter ('count'),
+    timing ('observe') and event ('event') recorded, with the stage and document in labels.
+    """
+    global enabled, _registry
+    _registry = registry or Registry()
+    _callbacks[:] = list(callbacks)
+    enabled = True
+    return _registry
+
+def disable():
+    """Stop recording; the registry keeps what was recorded so far."""
+    global enabled
+    enabled = False
+
+def registry():
+    """Return the registry metrics are recorded into, or None if telemetry was never enabled."""
+    return _registry
+
+def add_callback(callback):
+    _callbacks.append(callback)
+
+def _labels(labels):
+    current = _scope.get()
+    document = labels.pop('document', current.get('document'))
+    if 'stage' not in labels and 'stage' in current:
+        labels['stage'] = current['stage']
+    return labels, document
+
+def _notify(kind, name, value, labels, document):
+    for callback in _callbacks:
+        try:
+            callback(kind, name, value, dict(labels, document=document) if document is not None else labels)
+        except Exception:
+            pass  # A broken hook never stops a run
+
+def count(name, value=1, **labels):
+    """Add value to a counter, e.g. count('pasqui_api_calls_total', operation='chat')."""
+    if not enabled or not value:
+        return
+    labels, document = _labels(labels)
+    _registry.inc(name, value, labels, document)
+    if _callbacks:
+        _notify('count', name, value, labels, document)
+
+def observe(name, seconds, **labels):
+    """Record a duration in a latency histogram."""
+    if not enabled:
+        return
+    labels, document = _labels(labels)
+    _registry.observe(name, seconds, labels, document)
+    if _callbacks:
+        _notify('observe', name, seconds, labels, document)
+
+def event(name, **fields):
+    """Pass a per-document event (e.g. an extraction output) to the callbacks; nothing is stored.
+
+    `stage` and `document` fields are passed as labels, the other fields as the value.
+    """
+    if not enabled or not _callbacks:
+        return
+    labels, document = _labels({key: fields.pop(key) for key in ('stage', 'document') if key in fields})
+    _notify('event', name, fields, labels, document)
+
+class _Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+def timer(name, **labels):
+    """Return a context manager observing how long its block takes (a no-op while disabled)."""
+    if not enabled:
+        return _noop
+    return _Timer(name, labels)
+
+@contextlib.contextmanager
+def _scoped(values):
+    token = _scope.set(dict(_scope.get(), **values))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+def scope(**values):
+    """Return a context manager attributing what is recorded inside it to a stage and/or document."""
+    if not enabled:
+        return _noop
+    return _scoped(values)
+
+def record_usage(usage, **labels):
+    """Count the prompt and completion tokens of an OpenAI response's usage, if it reports any."""
+    if not enabled or usage is None:
+        return
+    count('pasqui_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, kind='prompt', **labels)
+    count('pasqui_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, kind='completion', **labels)
@@ -0,0 +1,17 @@
+import functools
+import tiktoken
+
+gpt = "gpt-4o-mini"
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=gpt):
+    """Return the tiktoken encoding of a model, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
+
+def encode(text, model=gpt):
+    """Return the tokens of a string (special-token markers are encoded as plain text)."""
+    return get_encoding(model).encode(text, disallowed_special=())
+
+def num_tokens(text, model=gpt):
+    """Return the number of tokens in a string."""
+    return len(encode(text, model))
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import socket
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+
+# Lease-based work queue shared by every worker of a run, in one SQLite file (local, or on a
+# mount every machine shares). Each task is a (stage, document) pair:
+#   pending -> leased (claimed by one worker until lease_until) -> done | failed
+# A worker claims tasks in one write transaction, so no two workers get the same one, and
+# heartbeats its leases while it works. A lease that is not renewed expires and the task is
+# handed to another worker; a failed attempt is retried after retry_delay seconds (doubling each
+# time), and after max_attempts claims the task is marked failed until a later run enqueues it
+# again. Resetting done tasks (redo) and failed ones happens once per run: workers that join a run
+# in progress only add new or changed tasks (see enqueue). Every lease carries a token: committing
+# with a token that is no longer current changes nothing, so a worker that lost its lease can never
+# overwrite the result of the one that took over.
+# A pending task's lease_until holds the time before which it is not claimed.
+# Note that SQLite locking relies on the filesystem: use a mount with working POSIX locks.
+# The same goes for the caches and signature index kept in the output folders (DiskCache,
+# dedup.SignatureIndex), which therefore use SQLite's rollback journal: WAL mode needs shared
+# memory between the processes and does not work on a network filesystem. Pass wal=True only
+# for files on local disk.
+
+Lease = namedtuple('Lease', 'stage name version token')
+
+def worker_id():
+    """Return a name for this process that is unique across the machines sharing a queue."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def temporary_path(path):
+    """Return a temporary path next to path, unique to this process and thread, to write then os.replace."""
+    return f"{path}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+
+def stage_key(stage, *inputs):
+    """Return the queue stage of a run with the given inputs (output folder, questions, models...),
+    so runs with different inputs sharing a queue file keep separate tasks."""
+    digest = hashlib.sha256(json.dumps(inputs, default=str).encode('utf-8')).hexdigest()[:16]
+    return f"{stage}:{digest}"
+
+def file_version(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime}"
+
+class LeaseQueue:
+    """Work queue over a SQLite file where workers claim, heartbeat and commit documents."""
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3, retry_delay=30, worker=None, poll_interval=None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker = worker or worker_id()
+        self.poll_interval = poll_interval or min(lease_seconds / 4, 5)
+        self._held = {}  # (stage, name) -> Lease renewed by the heartbeat thread
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                stage TEXT, name TEXT, version TEXT, state TEXT, worker TEXT, token TEXT,
+                lease_until REAL, attempts INTEGER DEFAULT 0, artefact TEXT, error TEXT, updated REAL,
+                PRIMARY KEY (stage, name));
+            CREATE INDEX IF NOT EXISTS tasks_state ON tasks (stage, state);
+            CREATE TABLE IF NOT EXISTS runs (stage TEXT PRIMARY KEY, run TEXT, started REAL);
+        ''')
+
+    def _write(self, statements):
+        """Run statements(connection) in one immediate (write-locked) transaction and return its result."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._conn)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    # Tasks --------------------------------------------------------------------------------
+
+    def enqueue(self, stage, items, retry_failed=True, redo=False, run=None):
+        """Add (name, version) tasks and return whether this call started a run of the stage.
+
+        A task whose version changed is reset to pending. The call that starts a run also resets
+        failed tasks unless retry_failed is False, and done ones with redo; other calls leave them
+        be, so a worker joining late never redoes or revives the tasks of the run it joins. With
+        run (any id shared by the workers of one run) a run starts at the first call with a new id;
+        without it, whenever the stage has no task pending or leased.
+        """
+        now = time.time()
+
+        def add_tasks(conn):
+            if run is None:
+                started = conn.execute('''SELECT 1 FROM tasks WHERE stage = ? AND state IN ('pending', 'leased')
+                                          LIMIT 1''', (stage,)).fetchone() is None
+            else:
+                started = conn.execute('SELECT 1 FROM runs WHERE stage = ? AND run = ?',
+                                       (stage, run)).fetchone() is None
+                if started:
+                    conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)', (stage, run, now))
+            states = ['failed'] if started and retry_failed else []
+            if started and redo:
+                states.append('done')
+            placeholders = ','.join('?' * len(states)) or 'NULL'
+            conn.executemany(f'''
+                INSERT INTO tasks (stage, name, version, state, updated) VALUES (?, ?, ?, 'pending', ?)
+                ON CONFLICT (stage, name) DO UPDATE SET
+                    version = excluded.version, state = 'pending', worker = NULL, token = NULL, lease_until = NULL,
+                    attempts = 0, artefact = NULL, error = NULL, updated = excluded.updated
+                WHERE tasks.version IS NOT excluded.version OR tasks.state IN ({placeholders})''',
+                             [(stage, name, version, now, *states) for name, version in items])
+            return started
+
+        return self._write(add_tasks)
+
+    def claim(self, stage, limit=1):
+        """Lease up to limit pending (or expired) tasks of a stage to this worker and return their Leases."""
+        def claim_tasks(conn):
+            now = time.time()
+            # Expired leases that used up their attempts are given up on
+            conn.execute('''UPDATE tasks SET state = 'failed', error = 'lease expired', updated = ?
+                            WHERE stage = ? AND state = 'leased' AND lease_until < ? AND attempts >= ?''',
+                         (now, stage, now, self.max_attempts))
+            rows = conn.execute('''SELECT name, version, state, worker FROM tasks
+                                   WHERE stage = ? AND ((state = 'pending' AND (lease_until IS NULL OR lease_until <= ?))
+                                                        OR (state = 'leased' AND lease_until < ?))
+                                   ORDER BY name LIMIT ?''', (stage, now, now, limit)).fetchall()
+            leases = []
+            for name, version, state, previous in rows:
+                token = uuid.uuid4().hex
+                conn.execute('''UPDATE tasks SET state = 'leased', worker = ?, token = ?, lease_until = ?,
+                                attempts = attempts + 1, updated = ? WHERE stage = ? AND name = ?''',
+                             (self.worker, token, now + self.lease_seconds, now, stage, name))
+                if state == 'leased':
+                    logging.warning(f"Lease of {stage} {name} held by {previous} expired, reassigned to {self.worker}")
+                leases.append(Lease(stage, name, version, token))
+            return leases
+
+        leases = self._write(claim_tasks)
+        if leases:
+            with self._lock:
+                for lease in leases:
+                    self._held[(lease.stage, lease.name)] = lease
+            self._start_heartbeat()
+        return leases
+
+    def heartbeat(self):
+        """Extend every lease this worker holds; leases taken over by another worker are dropped."""
+        with self._lock:
+            held = list(self._held.values())
+        if not held:
+            return
+        until = time.time() + self.lease_seconds
+
+        def renew(conn):
+            return [lease for lease in held if conn.execute(
+                '''UPDATE tasks SET lease_until = ? WHERE stage = ? AND name = ? AND token = ? AND state = 'leased' ''',
+                (until, lease.stage, lease.name, lease.token)).rowcount == 0]
+
+        for lease in self._write(renew):
+            logging.warning(f"Lost the lease of {lease.stage} {lease.name}")
+            self._drop(lease)
+
+    def _drop(self, lease):
+        with self._lock:
+            if self._held.get((lease.stage, lease.name)) == lease:
+                del self._held[(lease.stage, lease.name)]
+
+    def _finish(self, lease, statement, params):
+        """Apply an update guarded by the lease token and return whether it was applied."""
+        self._drop(lease)
+        return self._write(lambda conn: conn.execute(
+            statement + ' WHERE stage = ? AND name = ? AND token = ?',
+            (*params, lease.stage, lease.name, lease.token)).rowcount == 1)
+
+    def complete(self, lease, artefact=None):
+        """Commit a task's result. Returns False if the lease was lost and the commit ignored,
+        True if it was applied or the task was already done at this version."""
+        if self._finish(lease, '''UPDATE tasks SET state = 'done', artefact = ?, error = NULL, lease_until = NULL,
+                                  updated = ?''', (artefact, time.time())):
+            return True
+        return self.state(lease.stage, lease.name) == ('done', lease.version)
+
+    def fail(self, lease, error):
+        """Record a failed attempt: the task is retried after retry_delay * 2^(attempts - 1) seconds
+        until it was claimed max_attempts times."""
+        now = time.time()
+        return self._finish(lease, '''UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                      error = ?, lease_until = CASE WHEN attempts >= ? THEN NULL
+                                                                    ELSE ? * (1 << (attempts - 1)) + ? END,
+                                      updated = ?''',
+                            (self.max_attempts, str(error), self.max_attempts, self.retry_delay, now, now))
+
+    def release(self, lease):
+        """Give a task back untouched, without counting the attempt."""
+        return self._finish(lease, '''UPDATE tasks SET state = 'pending', attempts = attempts - 1, lease_until = NULL,
+                                      updated = ?''', (time.time(),))
+
+    def reset(self, stage, states=('failed',)):
+        """Put a stage's tasks in the given states back to pending, e.g. to retry failures."""
+        placeholders = ','.join('?' * len(states))
+        self._write(lambda conn: conn.execute(
+            f'''UPDATE tasks SET state = 'pending', attempts = 0, error = NULL, lease_until = NULL, updated = ?
+                WHERE stage = ? AND state IN ({placeholders})''', (time.time(), stage, *states)))
+
+    # Queries ------------------------------------------------------------------------------
+
+    def state(self, stage, name):
+        """Return (state, version) of a task, or None."""
+        with self._lock:
+            return self._conn.execute('SELECT state, version FROM tasks WHERE stage = ? AND name = ?',
+                                      (stage, name)).fetchone()
+
+    def results(self, stage, state='done'):
+        """Return a dict of name -> artefact (or error, for failed tasks) of a stage's tasks in a state."""
+        column = 'error' if state == 'failed' else 'artefact'
+        with self._lock:
+            rows = self._conn.execute(f'SELECT name, {column} FROM tasks WHERE stage = ? AND state = ? ORDER BY name',
+                                      (stage, state)).fetchall()
+        return dict(rows)
+
+    def stages(self):
+        """Return the names of the stages with tasks in the queue."""
+        with self._lock:
+            return [stage for (stage,) in self._conn.execute('SELECT DISTINCT stage FROM tasks ORDER BY stage')]
+
+    def stats(self, stage):
+        """Return the number of a stage's tasks in every state."""
+        with self._lock:
+            rows = self._conn.execute('SELECT state, COUNT(*) FROM tasks WHERE stage = ? GROUP BY state',
+                                      (stage,)).fetchall()
+        return dict({'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}, **dict(rows))
+
+    # Workers ------------------------------------------------------------------------------
+
+    def batches(self, stage, items, size=1, redo=False, run=None):
+        """Enqueue items (see enqueue) and yield batches of up to size Leases claimed by this worker.
+
+        Ends once every task of the stage is done or failed; while other workers still hold
+        leases, or failed attempts wait for their retry, it waits for them. The caller commits
+        every lease with complete or fail; leases left uncommitted when the next batch is asked
+        for are released.
+        """
+        self.enqueue(stage, items, redo=redo, run=run)
+        while True:
+            leases = self.claim(stage, size)
+            if leases:
+                yield leases
+                for lease in leases:
+                    if (lease.stage, lease.name) in self._held:
+                        self.release(lease)
+                continue
+            stats = self.stats(stage)
+            if not stats['pending'] and not stats['leased']:
+                if stats['failed']:
+                    logging.warning(f"{stats['failed']} tasks of {stage} failed {self.max_attempts} times, "
+                                    f"they are retried on the next run")
+                return
+            time.sleep(self.poll_interval)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                logging.error(f"Heartbeat failed: {e}")
+
+    def close(self):
+        """Stop heartbeating and release any lease still held."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            held = list(self._held.values())
+        for lease in held:
+            self.release(lease)
+        with self._lock:
+            self._conn.close()